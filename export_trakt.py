@@ -25,19 +25,24 @@ import sys, os
 # http://docs.python-requests.org/en/v2.4.3/user/advanced/#proxies
 try:
         import simplejson as json
-        import requests
-        requests.packages.urllib3.disable_warnings()
         import csv
 except:
         sys.exit("Please use your favorite method to install the following module requests and simplejson to use this script")
 
+import trakt_client
+import trakt_metrics
+
 import argparse
 import configparser
 import datetime
 import collections
+import heapq
+import logging
 import pprint
+import tempfile
 
 pp = pprint.PrettyPrinter(indent=4)
+log = logging.getLogger(__name__)
 
 desc="""This program export Movies or TVShows IDs from Trakt.tv list."""
 
@@ -62,19 +67,6 @@ _headers = {
         'Authorization'     : '',                   # required per API
 }
 
-_proxy = {
-        'proxy' : False,                # True or False, trigger proxy use
-        'host'  : 'https://127.0.0.1',  # Host/IP of the proxy
-        'port'  : '3128'                # Port of the proxy
-}
-
-_proxyDict = {
-        "http" : _proxy['host']+':'+_proxy['port'],
-        "https" : _proxy['host']+':'+_proxy['port']
-}
-
-response_arr = []
-
 def read_config(options):
         """
         Read config file and if provided overwrite default values
@@ -88,8 +80,7 @@ def read_config(options):
         _configfile = os.path.join(work_dir, options.config)
         if os.path.exists(options.config):
                 _configfile = options.config
-        if options.verbose:
-                print("Config file: {0}".format(_configfile))
+        log.debug("Config file: %s", _configfile)
         if os.path.exists(_configfile):
                 try:
                         config = configparser.ConfigParser()
@@ -114,13 +105,7 @@ def read_config(options):
                                 print('Warning, no refresh token found. Authentification is required')
                         if config.has_option('TRAKT','BASEURL'):
                                 _trakt['baseurl'] = config.get('TRAKT','BASEURL')
-                        if config.has_option('SETTINGS','PROXY'):
-                                _proxy['proxy'] = config.getboolean('SETTINGS','PROXY')
-                        if _proxy['proxy'] and config.has_option('SETTINGS','PROXY_HOST') and config.has_option('SETTINGS','PROXY_PORT'):
-                                _proxy['host'] = config.get('SETTINGS','PROXY_HOST')
-                                _proxy['port'] = config.get('SETTINGS','PROXY_PORT')
-                                _proxyDict['http'] = _proxy['host']+':'+_proxy['port']
-                                _proxyDict['https'] = _proxy['host']+':'+_proxy['port']
+                        trakt_client.read_config(config)
                         return config
                 except:
                         print("Error reading configuration file {0}".format(_configfile))
@@ -139,6 +124,8 @@ def read_config(options):
                         config.set('SETTINGS', 'PROXY', False)
                         config.set('SETTINGS', 'PROXY_HOST', 'https://127.0.0.1')
                         config.set('SETTINGS', 'PROXY_PORT', '3128')
+                        config.set('SETTINGS', 'POOL_SIZE', '10')
+                        config.set('SETTINGS', 'MAX_PAYLOAD', '1048576')
                         with open(_configfile, 'w') as configfile:
                                 config.write(configfile)
                                 print("Default settings wrote to file {0}".format(_configfile))
@@ -146,21 +133,232 @@ def read_config(options):
                         print("Error writing configuration file {0}".format(_configfile))
                 sys.exit(1)
 
+class ExportRow(object):
+        """
+        One CSV row of the export, only the fields written to the file
+        Slots instead of a dict per row, the show titles shared by the episodes are interned
+        """
+        __slots__ = ('id', 'time', 'season', 'episode', 'title')
+
+        def __init__(self, id, time, title, season=None, episode=None):
+            self.id = id
+            self.time = time
+            self.title = title
+            self.season = season
+            self.episode = episode
+
+        def values(self):
+            """Values of the row in the order of export_fields"""
+            if self.season is None:
+                return [self.id, self.time, self.title]
+            return [self.id, self.time, self.season, self.episode, self.title]
+
+        @classmethod
+        def from_values(cls, values):
+            """Rebuild a row from the values read back from a CSV file"""
+            if len(values) == 5:
+                return cls(values[0], values[1], sys.intern(values[4]), values[2], values[3])
+            return cls(values[0], values[1], values[2])
+
+def export_fields(options):
+        """CSV header of the export, depends on the ID format and the type"""
+        if options.type == 'episodes':
+            return [options.format, options.time, 'season', 'episode', 'show_title']
+        return [options.format, options.time, 'title']
+
+def sort_rows(options, rows, chunk_size=100000):
+        """
+        Sort rows by time in ascending order with an external merge sort
+        Sorted runs of chunk_size rows are spilled to temporary files then merged,
+        so only one run is held in memory
+        """
+        runs = []
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    chunk.sort(key = lambda row:(row.time))
+                    run = tempfile.TemporaryFile(mode='w+', encoding = 'utf-8', newline='')
+                    csv.writer(run).writerows(row.values() for row in chunk)
+                    run.seek(0)
+                    runs.append(run)
+                    chunk = []
+            chunk.sort(key = lambda row:(row.time))
+            readers = [(ExportRow.from_values(values) for values in csv.reader(run)) for run in runs]
+            # heapq.merge is stable, ties keep the order of the runs like sorted()
+            for row in heapq.merge(*readers, chunk, key = lambda row:(row.time)):
+                yield row
+        finally:
+            for run in runs:
+                run.close()
+
+def read_state(options):
+        """
+        Read the high-water mark of the previous incremental export of the output file
+        and the ids of the entries exported in the overlap window before it
+        Return None when there is no state or no output file, the export is then a full one
+        """
+        state_file = options.output + '.state'
+        if not os.path.isfile(state_file) or not os.path.isfile(options.output):
+            return None
+        with open(state_file, 'r', encoding = 'utf-8') as fp:
+            state = json.load(fp)
+        for key in ['list', 'listid', 'type', 'format']:
+            if state.get(key) != getattr(options, key):
+                print("Error, state file {file} was saved for {key} {state} not {value}, use another output file".format(
+                        file=state_file, key=key, state=state.get(key), value=getattr(options, key)))
+                sys.exit(1)
+        return state
+
+def overlap_start(options, watermark):
+        """Return the time --overlap days before the watermark, the entries after it are fetched again"""
+        start = datetime.datetime.strptime(watermark[:19], '%Y-%m-%dT%H:%M:%S') - datetime.timedelta(days=options.overlap)
+        return start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def entry_id(options, data):
+        """Return the id of a list entry, the history id of a play, the trakt ID of a collected item"""
+        return data.get('id') or data[options.type[:-1]]['ids']['trakt']
+
+def keep_recent(options, found):
+        """Only keep the (time, id) entries in the overlap window of the highest time seen so far"""
+        start = overlap_start(options, found['watermark'])
+        found['recent'] = [entry for entry in found['recent'] if entry[0] >= start]
+        found['keep'] = max(10000, 2 * len(found['recent']))
+
+def write_state(options, watermark, recent):
+        """
+        Save the high-water mark of the output file for the next incremental export
+        with the ids of the 'recent' (time, id) entries in the overlap window before it
+        """
+        state_file = options.output + '.state'
+        start = overlap_start(options, watermark)
+        state = {'list' : options.list, 'listid' : options.listid, 'type' : options.type, 'format' : options.format,
+                 'time' : options.time, 'watermark' : watermark,
+                 'seen' : sorted(set(myid for time, myid in recent if time >= start))}
+        with open(state_file + '.tmp', 'w', encoding = 'utf-8') as fp:
+            json.dump(state, fp, indent=4)
+        os.replace(state_file + '.tmp', state_file)
+
+def read_rows(options):
+        """Iterate over the rows of the existing output file, for an incremental export"""
+        with open(options.output, 'r', encoding = 'utf-8', newline='') as fp:
+            reader = csv.reader(fp, delimiter=options.delimiter)
+            fieldnames = next(reader, None)
+            if fieldnames != export_fields(options):
+                print("Error, can not append to {file}, the columns {fields} do not match {expected}".format(
+                        file=options.output, fields=fieldnames, expected=export_fields(options)))
+                sys.exit(1)
+            for values in reader:
+                yield values
+
 def write_csv(options, results):
-        """Write list output into a CSV file format"""
-        if options.verbose:
-                print("CSV output file: {0}".format(options.output))
+        """
+        Write list output into a CSV file format, row by row as they are fetched
+        On an incremental export the new rows are merged with the existing file,
+        first for the desc sort order, by time for the asc one so the back-dated rows go in their place
+        Return the number of new rows written
+        """
+        log.debug("CSV output file: %s", options.output)
         # sort
         if options.sortorder == 'asc':
-                sorted_results = sorted(results, key = lambda kv:(kv[options.time]))
-                results = sorted_results
+                results = sort_rows(options, results)
         # Write result CSV, works with windows now
-        with open(options.output, 'w', encoding = 'utf-8', newline='') as fp:
-                mycsv = csv.DictWriter(fp, fieldnames=list(results[0].keys()), delimiter=options.delimiter, quoting=csv.QUOTE_MINIMAL)
-                mycsv.writeheader()
-                for row in results:
-                    mycsv.writerow(row)
-        fp.close()
+        # Rows are written to a temporary file renamed once the export is complete
+        tmp_output = options.output + '.tmp'
+        count = 0
+        try:
+                with open(tmp_output, 'w', encoding = 'utf-8', newline='') as fp:
+                        mycsv = csv.writer(fp, delimiter=options.delimiter, quoting=csv.QUOTE_MINIMAL)
+                        mycsv.writerow(export_fields(options))
+                        if options.watermark and options.sortorder == 'asc':
+                            new = [0]
+                            def counted(rows):
+                                for row in rows:
+                                    new[0] += 1
+                                    yield row
+                            rows = (ExportRow.from_values(values) for values in read_rows(options))
+                            for row in heapq.merge(rows, counted(results), key = lambda row:(row.time)):
+                                mycsv.writerow(row.values())
+                            count = new[0]
+                        else:
+                            for row in results:
+                                mycsv.writerow(row.values())
+                                count += 1
+                        if options.watermark and options.sortorder == 'desc' and count > 0:
+                            mycsv.writerows(read_rows(options))
+                if count > 0:
+                        os.replace(tmp_output, options.output)
+        finally:
+                if os.path.exists(tmp_output):
+                        os.remove(tmp_output)
+        return count
+
+def export_rows(options, export_data, found):
+        """
+        Iterate over the CSV rows of the exported items, page by page
+        Keep in 'found' only what the duplicate and cleanup stages need
+        On an incremental export the entries fetched again in the overlap window and
+        exported by the previous run are skipped by id, the entries before it by time
+        """
+        for data in export_data:
+            if options.watermark and data[options.time] < options.start_at:
+                continue
+            if options.incremental:
+                myid = entry_id(options, data)
+                found['recent'].append((data[options.time], myid))
+                if not found['watermark'] or data[options.time] > found['watermark']:
+                    found['watermark'] = data[options.time]
+                if len(found['recent']) > found['keep']:
+                    keep_recent(options, found)
+                if myid in options.seen:
+                    continue
+            found['count'] += 1
+            row = export_row(options, data)
+            # Every item has a trakt ID, even the ones missing the --format one
+            found['dup_entries'][data[options.type[:-1]]['ids']['trakt']].append((data[options.time], data['id']))
+            # TODO add filter
+            #if data[options.time] == "2012-01-01T00:00:00.000Z":
+            if options.clean:
+                found['to_clean'].append({'ids': data[options.type[:-1]]['ids']})
+            if row:
+                yield row
+
+def export_row(options, data):
+        """Convert one Trakt list item into a CSV row of the requested format, None if the ID is missing"""
+        item = data[options.type[:-1]]
+        # If movie or show export by format imdb or tmdb
+        if options.type[:-1] != "episode" and options.format in ("imdb", "tmdb") and \
+            options.format in item['ids']:
+            return ExportRow(item['ids'][options.format], data[options.time], item['title'])
+        # If episode export by format tmdb or tvdb
+        elif options.type[:-1] == "episode" and options.format in ("tmdb", "tvdb") and \
+            options.format in item['ids']:
+            title = data['show']['title']
+            return ExportRow(item['ids'][options.format], data[options.time], sys.intern(title) if title else title,
+                             item['season'], item['number'])
+        return None
+
+def find_duplicates(options, dup_entries):
+        """
+        Return the history ids to remove so a single entry is kept per media ID
+        dup_entries group the (time, history id) of the entries by trakt ID, in one pass
+        The entry kept is the earliest or the latest one, see --keep
+        """
+        to_remove = []
+        for media_id, entries in dup_entries.items():
+            if len(entries) < 2:
+                continue
+            entries.sort()
+            if options.keep == 'earliest':
+                keep = entries[0]
+            else:
+                keep = entries[-1]
+            for entry in entries:
+                if entry is not keep:
+                    log.debug("Removing %s %s", media_id, entry[1])
+                    to_remove.append(entry[1])
+        return to_remove
 
 def api_auth(options, config=None, refresh=False):
         """API call for authentification OAUTH"""
@@ -192,7 +390,7 @@ def api_auth(options, config=None, refresh=False):
             }
 
         url = _trakt['baseurl'] + '/oauth/token'
-        request = requests.post(url, data=values)
+        request = trakt_client.post(url, data=values)
         if request.status_code == 200:
             response = request.json()
             #pp.pprint(response)
@@ -212,105 +410,44 @@ def api_auth(options, config=None, refresh=False):
             pp.pprint(request)
             sys.exit(1)
 
-def api_get_list(options, page):
-        """API call for Sync / Get list by type"""
-        url = _trakt['baseurl'] + '/sync/{list}/{type}?page={page}&limit={limit}'.format(
-                            list=options.list, type=options.type, page=page, limit=1000)
-        if options.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
-        #pp.pprint(r.headers)
-        if r.status_code != 200:
-            print("Error fetching Get {list}: {status} [{text}]".format(
-                    list=options.list, status=r.status_code, text=r.text))
-            return None
-        else:
-            global response_arr
-            response_arr += json.loads(r.text)
-        if int(r.headers['X-Pagination-Page-Count']) == 0:
-            print("No pages found after API call, trakt list may be empty")
-            return response_arr
-        # if 'X-Pagination-Page-Count'in r.headers and r.headers['X-Pagination-Page-Count'] != "0":
-        if 'X-Pagination-Page-Count' in r.headers and r.headers['X-Pagination-Page-Count']:
-            print("Fetched page {page} of {PageCount} pages for {list} list".format(
-                    page=page, PageCount=r.headers['X-Pagination-Page-Count'], list=options.list))
-            if page != int(r.headers['X-Pagination-Page-Count']):
-                api_get_list(options, page+1)
-
-        return response_arr
-
-def api_get_userlists(options, page):
+def api_get_list(options):
+        """API call for Sync / Get list by type, iterate over the items page by page"""
+        url = _trakt['baseurl'] + '/sync/{list}/{type}'.format(
+                            list=options.list, type=options.type)
+        log.debug("%s", url)
+        # Only the history can be filtered by date, other lists are filtered client side
+        params = {}
+        if options.watermark and options.list == 'history':
+            params['start_at'] = options.start_at
+        return trakt_client.iter_pages(url, options.list, headers=_headers, params=params)
+
+def api_get_userlists(options):
         """API call for Sync / Get userlists"""
-        url = _trakt['baseurl'] + '/users/{user}/lists'.format(
-                            user=options.userlist, page=page, limit=1000)
-        if options.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
-        #pp.pprint(r.headers)
-        if r.status_code != 200:
-            print("Error fetching Get {user}: {status} [{text}]".format(
-                    user=options.userlist, status=r.status_code, text=r.text))
-            return None
-        else:
-            global response_arr
-            response_arr += json.loads(r.text)
-        if 'X-Pagination-Page-Count' in r.headers and r.headers['X-Pagination-Page-Count']:
-            print("Fetched page {page} of {PageCount} pages for {user} list".format(
-                    page=page, PageCount=r.headers['X-Pagination-Page-Count'], user=options.userlist))
-            if page != int(r.headers['X-Pagination-Page-Count']):
-                api_get_list(options, page+1)
-
-        return response_arr
-
-def api_get_userlist(options, page):
-        """API call for Sync / Get list by type"""
-        url = _trakt['baseurl'] + '/users/{user}/lists/{list_id}/items/{type}?page={page}&limit={limit}'.format(
-                            user=options.userlist, list_id=options.listid, type=options.type, page=page, limit=1000)
-        if options.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
-        #pp.pprint(r.headers)
-        if r.status_code != 200:
-            print("Error fetching Get {list}: {status} [{text}]".format(
-                    user=options.userlist, status=r.status_code, text=r.text))
-            return None
-        else:
-            global response_arr
-            response_arr += json.loads(r.text)
-        if 'X-Pagination-Page-Count' in r.headers and r.headers['X-Pagination-Page-Count']:
-            print("Fetched page {page} of {PageCount} pages for {user} list".format(
-                    page=page, PageCount=r.headers['X-Pagination-Page-Count'], user=options.userlist))
-            if page != int(r.headers['X-Pagination-Page-Count']):
-                api_get_userlist(options, page+1)
+        url = _trakt['baseurl'] + '/users/{user}/lists'.format(user=options.userlist)
+        log.debug("%s", url)
+        return trakt_client.get_pages(url, options.userlist, headers=_headers)
 
-        return response_arr
+def api_get_userlist(options):
+        """API call for Sync / Get user list by type, iterate over the items page by page"""
+        url = _trakt['baseurl'] + '/users/{user}/lists/{list_id}/items/{type}'.format(
+                            user=options.userlist, list_id=options.listid, type=options.type)
+        log.debug("%s", url)
+        return trakt_client.iter_pages(url, options.userlist, headers=_headers)
 
 def api_remove_from_list(options, remove_data, is_id=False):
         """API call for Sync / Remove from list"""
         url = _trakt['baseurl'] + '/sync/{list}/remove'.format(list=options.list)
-        if options.type == 'episodes':
+        if is_id:
+            values = { 'ids' : remove_data }
+        elif options.type == 'episodes':
             values = { 'shows' : remove_data }
-        elif not is_id:
-            values = { options.type : remove_data }
         else:
-            values = { 'ids' : remove_data }
+            values = { options.type : remove_data }
         json_data = json.dumps(values)
-        if options.verbose:
-            print(url)
-            pp.pprint(json_data)
-        if _proxy['proxy']:
-            r = requests.post(url, data=json_data, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.post(url, data=json_data, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        log.debug("%s", json_data)
+        # Removing twice is harmless, retried on transient failures
+        r = trakt_client.post(url, data=json_data, headers=_headers, idempotent=True)
         if r.status_code != 200:
             print("Error removing items from {list}: {status} [{text}]".format(
                     list=options.list, status=r.status_code, text=r.text))
@@ -360,20 +497,45 @@ def main():
         parser.add_argument('-D', '--duplicate',
                       help='remove duplicate from list after export, default %(default)s',
                       default=False, action='store_true', dest='dup')
+        parser.add_argument('--keep',
+                      help='duplicate entry kept by --duplicate, by time, default %(default)s',
+                      choices=['earliest', 'latest'], dest='keep', default='latest')
+        parser.add_argument('-b', '--batch-size',
+                      help='number of items sent per API call, default %(default)s',
+                      type=trakt_client.positive_int, dest='batch_size', default=100)
+        parser.add_argument('-i', '--incremental',
+                      help='only export the items added since the previous export and merge them into the output file, default %(default)s',
+                      default=False, action='store_true', dest='incremental')
+        parser.add_argument('--overlap',
+                      help='days fetched again before the date of the previous --incremental export, to catch the back-dated plays, default %(default)s',
+                      type=trakt_client.non_negative_int, dest='overlap', default=7)
         parser.add_argument('-s', '--sort',
                       help='allow to overwrite sort order, default %(default)s',
                       choices=['asc', 'desc'], dest='sortorder', default='desc')
         #parser.add_argument('-d', '--dryrun',
         #              help='do not update the account, default %(default)s',
         #              default=True, action='store_true', dest='dryrun')
+        parser.add_argument('--metrics',
+                      help='write the run metrics to this file, as Prometheus text if it ends with .prom or as JSON otherwise, default %(default)s',
+                      action='store', type=str, dest='metrics', default=None)
+        parser.add_argument('-q', '--quiet',
+                      help='do not print the progress messages, eg: the pages fetched, the lists found or the dryrun batches, only the results and errors, default %(default)s',
+                      default=False, action='store_true', dest='quiet')
         parser.add_argument('-V', '--verbose',
-                      help='print additional verbose information, default %(default)s',
-                      default=True, action='store_true', dest='verbose')
+                      help='print additional verbose information, the URLs, payloads and results of every API call, default %(default)s',
+                      default=False, action='store_true', dest='verbose')
         options = parser.parse_args()
+        trakt_client.setup_logging(options.verbose, options.quiet)
+
+        if options.metrics:
+            trakt_metrics.enable(options.metrics)
 
         ## Display debug information
-        if options.verbose:
-            print("Options: %s" % options)
+        log.debug("Options: %s", options)
+
+        if options.dup and options.incremental:
+            print("Error, --duplicate can not be used with --incremental, the entries exported before are not fetched again")
+            sys.exit(1)
 
         if options.type == 'episodes' and options.list == "collection":
             print("Error, you can only fetch {0} from the history or watchlist list".format(options.type))
@@ -393,8 +555,7 @@ def main():
         config = read_config(options)
 
         ## Display debug information
-        if options.verbose:
-            print("Config: {}".format(config))
+        log.debug("Config: %s", config)
 
         ## Trakt auth
         if not _trakt['access_token'] and not _trakt['refresh_token'] and \
@@ -426,127 +587,97 @@ def main():
             sys.exit(1)
 
         ## Display debug information
-        if options.verbose:
-            print("Trakt: {}".format(_trakt))
-            print("Authorization header: {}".format(_headers['Authorization']))
-            print("trakt-api-key header: {}".format(_headers['trakt-api-key']))
+        log.debug("Trakt: %s", _trakt)
+        log.debug("Authorization header: %s", _headers['Authorization'])
+        log.debug("trakt-api-key header: %s", _headers['trakt-api-key'])
+
+        if options.list == 'history':
+            options.time = 'watched_at'
+        elif options.list == 'watchlist':
+            options.time = 'listed_at'
+        elif options.list == 'collection':
+            options.time = 'collected_at'
+        elif options.userlist != None:
+            options.time = 'listed_at'
 
         ## Get lists from Trakt user
-        export_data = []
         if options.userlist:
-            export_data = api_get_userlists(options, 1)
-            if export_data:
-                print("Found {0} user list".format(len(export_data)))
-                #pp.pprint(export_data)
-                for data in export_data:
-                    print("Found list id '{id}' name '{name}' with {items} items own by {own}".format(
-                            name=data['name'], id=data['ids']['trakt'], items=data['item_count'], own=data['user']['username']))
+            user_lists = api_get_userlists(options)
+            if user_lists:
+                print("Found {0} user list".format(len(user_lists)))
+                #pp.pprint(user_lists)
+                line = "Found list id '%s' name '%s' with %s items own by %s"
+                for data in user_lists:
+                    values = (data['ids']['trakt'], data['name'], data['item_count'], data['user']['username'])
+                    # Shown even with --quiet when the list id is asked for
+                    if options.listid == None:
+                        print(line % values)
+                    else:
+                        log.info(line, *values)
                 if options.listid == None:
                     print("Input the custom list id to export")
                     print("---alternatively add it to the command with `--listid 12345678` together with the --userlist username1")
                     options.listid = str(input('Input:'))
-
-                global response_arr ## Cleanup global....
-                response_arr = []
-
-                export_data = api_get_userlist(options, 1)
-                #pp.pprint(export_data)
-                if export_data:
-                    print("Found {0} Item-Count".format(len(export_data)))
             else:
                 print("Error, no item return for {type} from the user list {list}".format(
                     type=options.type, list=options.userlist))
                 sys.exit(1)
 
-        ## Get data from Trakt
-        if not export_data:
-            export_data = api_get_list(options, 1)
-            if export_data:
-                print("Found {0} Item-Count".format(len(export_data)))
+        ## Read the high-water mark of the previous export
+        options.watermark = None
+        options.seen = set()
+        if options.incremental:
+            state = read_state(options)
+            if state:
+                options.watermark = state['watermark']
+                options.start_at = overlap_start(options, options.watermark)
+                options.seen = set(state.get('seen', []))
+                print("Incremental export of the items added after {0}, checked from {1}".format(options.watermark, options.start_at))
             else:
-                print("Error, no item return for {type} from the {list} list".format(
-                    type=options.type, list=options.list))
-                sys.exit(1)
+                print("No previous export found for {0}, full export".format(options.output))
 
-        if options.list == 'history':
-            options.time = 'watched_at'
-        elif options.list == 'watchlist':
-            options.time = 'listed_at'
-        elif options.list == 'collection':
-            options.time = 'collected_at'
-        elif options.userlist != None:
-            options.time = 'listed_at'
+        ## Get data from Trakt
+        if options.userlist:
+            export_data = api_get_userlist(options)
+        else:
+            export_data = api_get_list(options)
+
+        ## Write export data into CSV file, page by page
+        found = {'count' : 0, 'watermark' : None, 'recent' : [], 'keep' : 10000, 'dup_entries' : collections.defaultdict(list), 'to_clean' : []}
+        try:
+            with trakt_metrics.timing('write_csv') as done:
+                written = done['items'] = write_csv(options, trakt_metrics.timed('convert',
+                                export_rows(options, trakt_metrics.timed('fetch', export_data), found)))
+        except trakt_client.APIError as e:
+            print(e)
+            sys.exit(1)
+        if found['count']:
+            print("Found {0} Item-Count".format(found['count']))
+        elif options.watermark:
+            print("No new item for {type} in the {list} list since {watermark}".format(
+                type=options.type, list=options.list, watermark=options.watermark))
+            sys.exit(0)
+        else:
+            print("Error, no item return for {type} from the {list} list".format(
+                type=options.type, list=options.list))
+            sys.exit(1)
 
-        export_csv = []
-        find_dupids = []
-        for data in export_data:
-            #pp.pprint(data)
-            # If movie or show export by format imdb
-            if options.type[:-1] != "episode" and 'imdb' in data[options.type[:-1]]['ids'] and \
-                options.format == "imdb":
-                find_dupids.append(data[options.type[:-1]]['ids']['imdb'])
-                export_csv.append({ 'imdb' : data[options.type[:-1]]['ids']['imdb'],
-                                    options.time : data[options.time],
-                                    'title' : data[options.type[:-1]]['title']})
-            # If movie or show export by format tmdb
-            elif options.type[:-1] != "episode" and 'tmdb' in data[options.type[:-1]]['ids'] and \
-                options.format == "tmdb":
-                find_dupids.append(data[options.type[:-1]]['ids']['tmdb'])
-                export_csv.append({ 'tmdb' : data[options.type[:-1]]['ids']['tmdb'],
-                                    options.time : data[options.time],
-                                    'title' : data[options.type[:-1]]['title']})
-            # If episode export by format tmdb
-            elif 'tmdb' in data[options.type[:-1]]['ids'] and \
-                options.format == "tmdb":
-                find_dupids.append(data[options.type[:-1]]['ids']['tmdb'])
-                if not data['episode']['title']: data['episode']['title'] = "no episode title"
-                export_csv.append({ 'tmdb' : data[options.type[:-1]]['ids']['tmdb'],
-                                    options.time : data[options.time],
-                                    'season' : data[options.type[:-1]]['season'],
-                                    'episode' : data[options.type[:-1]]['number'],
-                                    'show_title' : data['show']['title']})
-            # If episode export by format tvdb
-            elif 'tvdb' in data[options.type[:-1]]['ids'] and \
-                options.format == "tvdb":
-                find_dupids.append(data[options.type[:-1]]['ids']['tvdb'])
-                if not data['episode']['title']: data['episode']['title'] = "no episode title"
-                export_csv.append({ 'tvdb' : data[options.type[:-1]]['ids']['tvdb'],
-                                    options.time : data[options.time],
-                                    'season' : data[options.type[:-1]]['season'],
-                                    'episode' : data[options.type[:-1]]['number'],
-                                    'show_title' : data['show']['title']})
-        # print(export_csv)
-        if len(export_csv) == 0:
+        if written == 0:
             print("Warning no data to export, probably a bug")
             sys.exit(1)
-        ## Write export data into CSV file
-        write_csv(options, export_csv)
+
+        ## Save the high-water mark for the next export
+        if options.incremental:
+            write_state(options, found['watermark'], found['recent'])
 
         ## Empty list after export
         if options.clean:
             cleanup_results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0}
-            to_remove = []
-            for data in export_data:
-                # TODO add filter
-                #if data[options.time] == "2012-01-01T00:00:00.000Z":
-                to_remove.append({'ids': data[options.type[:-1]]['ids']})
-                if len(to_remove) >= 10: # Remove by batch of 10
-                    cleanup_results['sentids'] += len(to_remove)
-                    result = api_remove_from_list(options, to_remove)
-                    if result:
-                        print("Result: {0}".format(result))
-                        if 'deleted' in result and result['deleted']:
-                            cleanup_results['deleted'] += result['deleted'][options.type]
-                        if 'not_found' in result and result['not_found']:
-                            cleanup_results['not_found'] += len(result['not_found'][options.type])
-                    to_remove = []
-            # Remove the rest
-            if len(to_remove) > 0:
-                #print pp.pprint(data)
-                cleanup_results['sentids'] += len(to_remove)
-                result = api_remove_from_list(options, to_remove)
+            for batch in trakt_client.batches(found['to_clean'], options.batch_size):
+                cleanup_results['sentids'] += len(batch)
+                result = api_remove_from_list(options, batch)
                 if result:
-                    print("Result: {0}".format(result))
+                    log.debug("Result: %s", result)
                     if 'deleted' in result and result['deleted']:
                         cleanup_results['deleted'] += result['deleted'][options.type]
                     if 'not_found' in result and result['not_found']:
@@ -556,47 +687,31 @@ def main():
                 deleted=cleanup_results['deleted'], not_found=cleanup_results['not_found']))
 
         ## Find duplicate and remove duplicate
-        dup_ids = [item for item, count in list(collections.Counter(find_dupids).items()) if count > 1]
+        # Reported by trakt ID, the same groups --duplicate removes from
+        dup_ids = [media_id for media_id, entries in found['dup_entries'].items() if len(entries) > 1]
         print("Found {dups} duplicate out of {total} {entry}".format(
-                    entry=options.type, dups=len(dup_ids), total=len(find_dupids)))
+                    entry=options.type, dups=len(dup_ids), total=sum(len(entries) for entries in found['dup_entries'].values())))
         if options.dup:
             if len(dup_ids) > 0:
                 print(dup_ids)
             dup_results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0}
-            to_remove = []
-            for dupid in find_dupids:
-                count = 0
-                for data in export_data:
-                    if data[options.type[:-1]]['ids']['imdb'] == dupid:
-                        #print "{0} {1}".format(dupid, data['id'])
-                        count += 1
-                        if count > 1:
-                            print("Removing {0} {1}".format(dupid, data['id']))
-                            to_remove.append(data['id'])
-                            dup_results['sentids'] += len(to_remove)
-                            result = api_remove_from_list(options, to_remove, is_id=True)
-                            if len(to_remove) >= 10: # Remove by batch of 10
-                                if result:
-                                    print("Result: {0}".format(result))
-                                    if 'deleted' in result and result['deleted']:
-                                        dup_results['deleted'] += result['deleted'][options.type]
-                                    if 'not_found' in result and result['not_found']:
-                                        dup_results['not_found'] += len(result['not_found'][options.type])
-                                    to_remove = []
-            ## Remove the rest
-            if len(to_remove) > 0:
-                dup_results['sentids'] += len(to_remove)
-                result = api_remove_from_list(options, to_remove, is_id=True)
+            to_remove = find_duplicates(options, found['dup_entries'])
+            for batch in trakt_client.batches(to_remove, options.batch_size):
+                dup_results['sentids'] += len(batch)
+                result = api_remove_from_list(options, batch, is_id=True)
                 if result:
-                    print("Result: {0}".format(result))
+                    log.debug("Result: %s", result)
                     if 'deleted' in result and result['deleted']:
                         dup_results['deleted'] += result['deleted'][options.type]
                     if 'not_found' in result and result['not_found']:
                         dup_results['not_found'] += len(result['not_found'][options.type])
-                    to_remove = []
             print("Overall {dup} duplicate {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
                 dup=len(dup_ids), sent=dup_results['sentids'], type=options.type,
                 deleted=dup_results['deleted'], not_found=dup_results['not_found']))
 
+        ## Display HTTP latency stats
+        if options.verbose:
+            trakt_client.print_stats()
+
 if __name__ == '__main__':
         main()
@@ -25,20 +25,29 @@ import sys, os
 # http://docs.python-requests.org/en/v2.4.3/user/advanced/#proxies
 try:
         import simplejson as json
-        import requests
-        requests.packages.urllib3.disable_warnings()
         import csv
 except:
         sys.exit("Please use your favorite method to install the following module requests and simplejson to use this script")
 
+import trakt_client
+import trakt_async
+import trakt_cache
+import trakt_journal
+import trakt_metrics
+
 import argparse
+import asyncio
 import configparser
 import datetime
 import collections
+import concurrent.futures
+import itertools
+import logging
 import pprint
 import time
 
 pp = pprint.PrettyPrinter(indent=4)
+log = logging.getLogger(__name__)
 
 desc="""This program import Movies or TVShows IDs into Trakt.tv."""
 
@@ -53,6 +62,10 @@ _trakt = {
         'baseurl'       :       'https://api.trakt.tv', # Sandbox environment https://api-staging.trakt.tv,
 }
 
+# ID formats of the CSV, Search / ID Lookup only support some of them
+_formats = ['imdb', 'tmdb', 'tvdb', 'tvrage', 'trakt']
+_search_formats = ['imdb', 'tmdb', 'tvdb', 'trakt']
+
 _headers = {
         'Accept'            : 'application/json',   # required per API
         'Content-Type'      : 'application/json',   # required per API
@@ -63,19 +76,6 @@ _headers = {
         'Authorization'     : '',                   # required per API
 }
 
-_proxy = {
-        'proxy' : False,                # True or False, trigger proxy use
-        'host'  : 'https://127.0.0.1',  # Host/IP of the proxy
-        'port'  : '3128'                # Port of the proxy
-}
-
-_proxyDict = {
-        "http" : _proxy['host']+':'+_proxy['port'],
-        "https" : _proxy['host']+':'+_proxy['port']
-}
-
-response_arr = []
-
 def read_config(options):
         """
         Read config file and if provided overwrite default values
@@ -89,8 +89,7 @@ def read_config(options):
         _configfile = os.path.join(work_dir, options.config)
         if os.path.exists(options.config):
                 _configfile = options.config
-        if options.verbose:
-                print("Config file: {0}".format(_configfile))
+        log.debug("Config file: %s", _configfile)
         if os.path.exists(_configfile):
                 try:
                         config = configparser.ConfigParser()
@@ -115,13 +114,8 @@ def read_config(options):
                                 print('Warning, no refresh token found. Authentification is required')
                         if config.has_option('TRAKT','BASEURL'):
                                 _trakt['baseurl'] = config.get('TRAKT','BASEURL')
-                        if config.has_option('SETTINGS','PROXY'):
-                                _proxy['proxy'] = config.getboolean('SETTINGS','PROXY')
-                        if _proxy['proxy'] and config.has_option('SETTINGS','PROXY_HOST') and config.has_option('SETTINGS','PROXY_PORT'):
-                                _proxy['host'] = config.get('SETTINGS','PROXY_HOST')
-                                _proxy['port'] = config.get('SETTINGS','PROXY_PORT')
-                                _proxyDict['http'] = _proxy['host']+':'+_proxy['port']
-                                _proxyDict['https'] = _proxy['host']+':'+_proxy['port']
+                        trakt_client.read_config(config)
+                        trakt_cache.read_config(config)
                         return config
                 except:
                         print("Error reading configuration file {0}".format(_configfile))
@@ -140,6 +134,8 @@ def read_config(options):
                         config.set('SETTINGS', 'PROXY', False)
                         config.set('SETTINGS', 'PROXY_HOST', 'https://127.0.0.1')
                         config.set('SETTINGS', 'PROXY_PORT', '3128')
+                        config.set('SETTINGS', 'POOL_SIZE', '10')
+                        config.set('SETTINGS', 'MAX_PAYLOAD', '1048576')
                         with open(_configfile, 'w') as configfile:
                                 config.write(configfile)
                                 print("Default settings wrote to file {0}".format(_configfile))
@@ -148,9 +144,214 @@ def read_config(options):
                 sys.exit(1)
 
 def read_csv(options):
-        """Read CSV of Movies or TVShows IDs and return a dict"""
+        """Read CSV of Movies or TVShows IDs, iterate over the rows as dict"""
+        reader = csv.DictReader(options.input, delimiter=options.delimiter)
+        for row in reader:
+            yield row
+
+def row_id(options, myid):
+        """
+        Return the (format, id) of a CSV row, None if the row has no ID
+        The --format column is used first, then any other ID column of the row
+        """
+        for id_format in [options.format] + _formats:
+            if myid.get(id_format):
+                value = myid[id_format]
+                # If format is not "imdb" it must be cast to an integer
+                if not id_format == "imdb" and not value.startswith('tt'):
+                    value = int(value)
+                return id_format, value
+        return None
+
+def import_items(options, read_ids, found, dead_letter=None):
+        """
+        Validate the CSV rows and convert them into trakt format, one by one
+        Rows without the --format column fall back on any other ID column
+        Count the rows read in 'found', every ID column of a row is kept by the dead letter
+        """
+        for myid in read_ids:
+            found['rows'] += 1
+            # If id (row) exists and is not blank (has a format)
+            if myid and not any(id_format in myid for id_format in _formats):
+                print("Invalid file format, id (row) must exists and is not blank (has a format).")
+                sys.exit(1)
+            key = row_id(options, myid) if myid else None
+            if key:
+                #pp.pprint(myid)
+                ids = {key[0] : key[1]}
+                if options.retry and not options.seen:
+                    # A dead-letter row keeps the fields of the item as it was sent
+                    item = dict((k, myid[k]) for k in ('watched_at', 'rated_at', 'rating') if myid.get(k))
+                    item['ids'] = ids
+                elif (options.type == "movies" or options.type == "shows") and options.seen:
+                    item = {'ids':ids, "watched_at": options.seen}
+                elif (options.type == "movies" or options.type == "shows") and options.watched_at:
+                    item = {'ids':ids, "watched_at": myid["watched_at"]}
+                elif options.type == "episodes" and options.seen:
+                    item = {'ids':ids,"watched_at": options.seen}
+                elif options.type == "episodes" and options.watched_at:
+                    item = {'ids':ids,"watched_at": myid["watched_at"]}
+                elif (options.type == "movies" or options.type == "shows") and options.list == 'ratings' and options.rated_at:
+                    item = {'ids':ids, "rated_at": myid["rated_at"], "rating": myid["rating"]}
+                else:
+                    item = {'ids':ids}
+                if dead_letter:
+                    dead_letter.track(item, myid.get('row_ids') or row_ids(myid))
+                yield item
+
+def row_ids(myid):
+        """Return every ID column of a CSV row"""
+        return dict((id_format, myid[id_format]) for id_format in _formats if myid.get(id_format))
+
+def search_ids(options, results):
+        """Return the ids block of the search result matching --type, None if not found"""
+        if not results:
+            return None
+        for result in results:
+            if result.get('type') == options.type[:-1]:
+                return result[options.type[:-1]]['ids']
+        return None
+
+def resolve_rows(options, read_ids, found, dead_letter=None):
+        """
+        Retry pass over the rows of a dead-letter CSV, the failed rows are sent as they are
+        A not found row is looked up by each of its ID columns, --format first, and sent by the
+        trakt ID of the first result matching --type, the rows still not found go to the dead letter
+        """
+        for myid in read_ids:
+            if myid.get('reason') == 'failed':
+                yield myid
+                continue
+            ids = None
+            for id_format in lookup_formats(options, myid):
+                found['lookups'] += 1
+                ids = search_ids(options, api_search_by_id(options, myid[id_format], id_format))
+                if ids and ids.get('trakt'):
+                    break
+            row = resolved_row(options, myid, ids, found, dead_letter)
+            if row:
+                yield row
+
+async def async_resolve_rows(options, client, read_ids, found, dead_letter=None):
+        """
+        Retry pass with the asyncio engine, the not found rows of a chunk are looked up concurrently
+        Return the rows to send again
+        """
+        rows = []
+        for chunk in read_chunks(read_ids):
+            missing = []
+            for myid in chunk:
+                if myid.get('reason') == 'failed':
+                    rows.append(myid)
+                else:
+                    missing.append(myid)
+            lookups = await asyncio.gather(*[async_resolve_row(options, client, myid, found) for myid in missing])
+            for myid, ids in zip(missing, lookups):
+                row = resolved_row(options, myid, ids, found, dead_letter)
+                if row:
+                    rows.append(row)
+        return rows
+
+async def async_resolve_row(options, client, myid, found):
+        """Look up a not found row by each of its ID columns, return the ids block of the first match"""
+        ids = None
+        for id_format in lookup_formats(options, myid):
+            found['lookups'] += 1
+            ids = search_ids(options, await client.api_search_by_id(options, myid[id_format], id_format))
+            if ids and ids.get('trakt'):
+                break
+        return ids
+
+def lookup_formats(options, myid):
+        """Return the ID columns a not found row is looked up by, --format first"""
+        return [id_format for id_format in [options.format] + [f for f in _search_formats if f != options.format]
+                if myid.get(id_format) and id_format in _search_formats]
+
+def resolved_row(options, myid, ids, found, dead_letter=None):
+        """Return the row to send again by the trakt ID found for it, None if still not found"""
+        if ids and ids.get('trakt'):
+            found['resolved'] += 1
+            # Only keep the trakt ID, row_id falls back on it
+            # the dead letter writes the row again with all its IDs if it is still not imported
+            myid = dict(myid, row_ids=row_ids(myid), **dict((id_format, '') for id_format in _formats))
+            myid['trakt'] = str(ids['trakt'])
+            return myid
+        found['unresolved'] += 1
+        if dead_letter:
+            dead_letter.write([row_item(myid)], options.list, 'not_found')
+        return None
+
+def row_item(myid):
+        """Return a dead-letter row as an item, with its ID columns and its extra fields"""
+        item = dict((k, myid[k]) for k in ('watched_at', 'rated_at', 'rating') if myid.get(k))
+        item['ids'] = row_ids(myid)
+        return item
+
+def translate_csv(options):
+        """
+        Fill in every ID format of the CSV rows and write them to the --translate file
+        Rows are read by chunk, the distinct IDs of a chunk are resolved concurrently
+        through the ID cache and the search API, by threads or by the asyncio engine
+        """
         reader = csv.DictReader(options.input, delimiter=options.delimiter)
-        return list(reader)
+        fieldnames = list(reader.fieldnames or [])
+        fieldnames += [id_format for id_format in _search_formats if id_format not in fieldnames]
+        results = {'rows' : 0, 'lookups' : 0, 'translated' : 0, 'not_found' : 0}
+        with open(options.translate, 'w', encoding = 'utf-8', newline='') as fp:
+            mycsv = csv.DictWriter(fp, fieldnames=fieldnames, delimiter=options.delimiter, quoting=csv.QUOTE_MINIMAL)
+            mycsv.writeheader()
+            if options.async_engine:
+                asyncio.run(async_translate(options, reader, mycsv, results))
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+                    for chunk in read_chunks(reader):
+                        keys = chunk_lookups(options, chunk)
+                        futures = [executor.submit(api_search_by_id, options, key[1], key[0]) for key in keys]
+                        write_translated(options, mycsv, chunk, dict(zip(keys, (f.result() for f in futures))), results)
+        print("Overall translated {translated} out of {rows} {type} with {lookups} lookups, not_found:{not_found}".format(
+                translated=results['translated'], rows=results['rows'], type=options.type,
+                lookups=results['lookups'], not_found=results['not_found']))
+
+async def async_translate(options, reader, mycsv, results):
+        """Translate with the asyncio engine, the distinct IDs of a chunk are looked up concurrently"""
+        async with trakt_async.Client(_trakt['baseurl'], _headers, options.concurrency) as client:
+            for chunk in read_chunks(reader):
+                keys = chunk_lookups(options, chunk)
+                lookups = await asyncio.gather(*[client.api_search_by_id(options, key[1], key[0]) for key in keys])
+                write_translated(options, mycsv, chunk, dict(zip(keys, lookups)), results)
+
+def read_chunks(rows, size=1000):
+        """Iterate over the rows by list of at most 'size' rows"""
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                return
+            yield chunk
+
+def chunk_lookups(options, chunk):
+        """Return the distinct (format, id) of the rows of a chunk that can be looked up"""
+        lookups = {}
+        for myid in chunk:
+            key = row_id(options, myid)
+            if key and key[0] in _search_formats:
+                lookups[key] = True
+        return list(lookups)
+
+def write_translated(options, mycsv, chunk, lookups, results):
+        """Fill in the ID formats of the rows of a chunk from the lookup results keyed on (format, id), and write them"""
+        results['lookups'] += len(lookups)
+        for myid in chunk:
+            results['rows'] += 1
+            key = row_id(options, myid)
+            ids = search_ids(options, lookups[key]) if key in lookups else None
+            if ids:
+                results['translated'] += 1
+                for id_format in _search_formats:
+                    if not myid.get(id_format) and ids.get(id_format):
+                        myid[id_format] = ids[id_format]
+            else:
+                results['not_found'] += 1
+            mycsv.writerow(myid)
 
 def api_auth(options, config=None, refresh=False):
         """API call for authentification OAUTH"""
@@ -182,7 +383,7 @@ def api_auth(options, config=None, refresh=False):
             }
 
         url = _trakt['baseurl'] + '/oauth/token'
-        request = requests.post(url, data=values)
+        request = trakt_client.post(url, data=values)
         if request.status_code == 200:
             response = request.json()
             #pp.pprint(response)
@@ -202,52 +403,36 @@ def api_auth(options, config=None, refresh=False):
             pp.pprint(request)
             sys.exit(1)
 
-def api_search_by_id(options, id):
-        """API call for Search / ID Lookup / Get ID lookup results"""
-        url = _trakt['baseurl'] + '/search?id_type={0}&id={1}'.format(options.format, id)
-        if options.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
+def api_search_by_id(options, id, id_type=None):
+        """API call for Search / ID Lookup / Get ID lookup results, answered from the ID cache when possible"""
+        if id_type is None:
+            id_type = options.format
+        cache = trakt_cache.ids()
+        if cache:
+            results = cache.get(id_type, id)
+            if results is not None:
+                return results
+        url = _trakt['baseurl'] + '/search?id_type={0}&id={1}'.format(id_type, id)
+        log.debug("%s", url)
+        r = trakt_client.get(url, headers=_headers)
         if r.status_code != 200:
             print("Error Get ID lookup results: {0} [{1}]".format(r.status_code, r.text))
             return None
         else:
-            return json.loads(r.text)
-
-def api_get_list(options, page):
-        """API call for Sync / Get list by type"""
-        url = _trakt['baseurl'] + '/sync/{list}/{type}?page={page}&limit={limit}'.format(
-                            list=options.list, type=options.type, page=page, limit=1000)
-        if options.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
-        #pp.pprint(r.headers)
-        if r.status_code != 200:
-            print("Error fetching Get {list}: {status} [{text}]".format(
-                    list=options.list, status=r.status_code, text=r.text))
-            return None
-        else:
-            global response_arr
-            response_arr += json.loads(r.text)
-        if 'X-Pagination-Page-Count'in r.headers and r.headers['X-Pagination-Page-Count']:
-            print("Fetched page {page} of {PageCount} pages for {list} list".format(
-                    page=page, PageCount=r.headers['X-Pagination-Page-Count'], list=options.list))
-            if page < int(r.headers['X-Pagination-Page-Count']):
-                api_get_list(options, page+1)
-
-        return response_arr
+            results = json.loads(r.text)
+            if cache:
+                cache.set(id_type, id, results)
+            return results
+
+def api_get_list(options):
+        """API call for Sync / Get list by type, iterate over the items page by page"""
+        url = _trakt['baseurl'] + '/sync/{list}/{type}'.format(
+                            list=options.list, type=options.type)
+        log.debug("%s", url)
+        return trakt_client.iter_pages(url, options.list, headers=_headers)
 
 def api_add_to_list(options, import_data):
         """API call for Sync / Add items to list"""
-        # 429 [AUTHED_API_POST_LIMIT rate limit exceeded. Please wait 1 seconds then retry your request.]
-        # Rate limit for API
-        time.sleep(1)
         url = _trakt['baseurl'] + '/sync/{list}'.format(list=options.list)
         #values = '{ "movies": [ { "ids": { "imdb": "tt0000111" } }, { "ids": { , "imdb": "tt1502712" } } ] }'
         #values = '{ "movies": [ { "watched_at": "2014-01-01T00:00:00.000Z", "ids": { "imdb": "tt0000111" } }, { "watched_at": "2013-01-01T00:00:00.000Z", "ids": { "imdb": "tt1502712" } } ] }'
@@ -256,42 +441,39 @@ def api_add_to_list(options, import_data):
         else:
             values = { options.type : import_data }
 
+        start = time.perf_counter()
         json_data = json.dumps(values)
-        if options.verbose:
-            print("Sending to URL: {0}".format(url))
-            pp.pprint(json_data)
+        trakt_metrics.stage('build_payload', 0, time.perf_counter() - start)
+        log.debug("Sending to URL: %s", url)
+        log.debug("%s", json_data)
 
-        if _proxy['proxy']:
-            #print(url)
-            r = requests.post(url, data=json_data, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.post(url, data=json_data, headers=_headers, timeout=(5, 60))
+        # Adding twice is harmless except to the history, where each add is a new play
+        start = time.perf_counter()
+        r = trakt_client.post(url, data=json_data, headers=_headers, idempotent=options.list != 'history')
+        trakt_metrics.stage('post', len(import_data), time.perf_counter() - start)
 
         if r.status_code != 201:
             print("Error Adding items to {list}: {status} [{text}]".format(
                     list=options.list, status=r.status_code, text=r.text))
             return None
         else:
-            return json.loads(r.text)
+            start = time.perf_counter()
+            result = json.loads(r.text)
+            trakt_metrics.stage('parse', len(import_data), time.perf_counter() - start)
+            return result
 
 def api_remove_from_list(options, remove_data):
         """API call for Sync / Remove from list"""
-        # 429 [AUTHED_API_POST_LIMIT rate limit exceeded. Please wait 1 seconds then retry your request.]
-        # Rate limit for API
-        time.sleep(1)
         url = _trakt['baseurl'] + '/sync/{list}/remove'.format(list=options.list)
         if options.type == 'episodes':
             values = { 'shows' : remove_data }
         else:
             values = { options.type : remove_data }
         json_data = json.dumps(values)
-        if options.verbose:
-            print(url)
-            pp.pprint(json_data)
-        if _proxy['proxy']:
-            r = requests.post(url, data=json_data, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.post(url, data=json_data, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        log.debug("%s", json_data)
+        # Removing twice is harmless, retried on transient failures
+        r = trakt_client.post(url, data=json_data, headers=_headers, idempotent=True)
         if r.status_code != 200:
             print("Error removing items from {list}: {status} [{text}]".format(
                     list=options.list, status=r.status_code, text=r.text))
@@ -299,42 +481,136 @@ def api_remove_from_list(options, remove_data):
         else:
             return json.loads(r.text)
 
-def cleanup_list(options):
-        """Empty list prior to import"""
-        export_data = api_get_list(options, 1)
-        if export_data != None:
-            print("Found {0} Item-Count".format(len(export_data)))
+def sum_results(options, results, result):
+        """Add the counts of one sync API result to the overall results"""
+        if result:
+            log.debug("Result: %s", result)
+            for key in ('added', 'existing', 'deleted'):
+                if key in results and key in result and result[key]:
+                    results[key] += result[key][options.type]
+            if 'not_found' in result and result['not_found']:
+                results['not_found'] += len(result['not_found'][options.type])
         else:
+            results['failed'] += 1
+
+def send_batches(options, results, batches, api_call, journal=None, dead_letter=None):
+        """
+        Count the IDs of each batch as sent and produce the API call for it
+        With a journal the batches done by a previous run are skipped, the others are recorded
+        With a dead letter the items not imported are written to it
+        """
+        for ordinal, batch in enumerate(batches):
+            if journal:
+                key = journal.key(options, ordinal, batch)
+                if journal.skip(key, results):
+                    if dead_letter:
+                        dead_letter.forget(batch)
+                    continue
+                journal.pending(key, len(batch))
+            results['sentids'] += len(batch)
+            call = api_call(options, batch)
+            if dead_letter:
+                call = dead_letter.record(options, batch, call)
+            if journal:
+                call = journal.finish(options, key, len(batch), call)
+            yield call
+
+def cleanup_ids(options, export_data):
+        """Keep only the ids, the list must be fully read before removing from it"""
+        try:
+            to_remove = [{'ids': data[options.type[:-1]]['ids']} for data in export_data]
+        except trakt_client.APIError as e:
+            print(e)
             print("Error, Cleanup no item return for {type} from the {list} list".format(
                 type=options.type, list=options.list))
             sys.exit(1)
-        results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0}
-        to_remove = []
-        for data in export_data:
-            to_remove.append({'ids': data[options.type[:-1]]['ids']})
-            if len(to_remove) >= 10:
-                results['sentids'] += len(to_remove)
-                result = api_remove_from_list(options, to_remove)
-                if result:
-                    print("Result: {0}".format(result))
-                    if 'deleted' in result and result['deleted']:
-                        results['deleted'] += result['deleted'][options.type]
-                    if 'not_found' in result and result['not_found']:
-                        results['not_found'] += len(result['not_found'][options.type])
-                to_remove = []
-        # Remove the rest
-        if len(to_remove) > 0:
-            #pp.pprint(data)
-            results['sentids'] += len(to_remove)
-            result = api_remove_from_list(options, to_remove)
-            if result:
-                print("Result: {0}".format(result))
-                if 'deleted' in result and result['deleted']:
-                    results['deleted'] += result['deleted'][options.type]
-                if 'not_found' in result and result['not_found']:
-                    results['not_found'] += len(result['not_found'][options.type])
+        print("Found {0} Item-Count".format(len(to_remove)))
+        return to_remove
+
+def cleanup_list(options, journal=None):
+        """Empty list prior to import, unless the journal shows it was emptied by the run being resumed"""
+        if journal and journal.cleaned:
+            print("Resume, skip cleanup of the {list} list already emptied".format(list=options.list))
+            return
+        to_remove = cleanup_ids(options, api_get_list(options))
+        results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0, 'failed' : 0}
+        for result in send_batches(options, results, trakt_client.batches(to_remove, options.batch_size), api_remove_from_list):
+            sum_results(options, results, result)
         print("Overall cleanup {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
             sent=results['sentids'], type=options.type, deleted=results['deleted'], not_found=results['not_found']))
+        if journal and not results['failed']:
+            journal.clean()
+
+def list_diff(options, export_data):
+        """Return the diff against the items of the list, fetched on every run so the changes made on trakt.tv are seen"""
+        items = trakt_cache.index_items(data['ids'] for data in cleanup_ids(options, export_data))
+        print("Found {count} items in the {list} list".format(count=len(items), list=options.list))
+        return trakt_cache.ListDiff(items)
+
+def diff_removed(options, results):
+        """Print the results of the removal of the list items missing from the CSV"""
+        print("Overall removed {sent} {type} not in the CSV, results deleted:{deleted}, not_found:{not_found}".format(
+            sent=results['sentids'], type=options.type, deleted=results['deleted'], not_found=results['not_found']))
+
+def diff_list(options, data, results, dead_letter=None):
+        """Add the CSV items missing from the list, then remove the list items missing from the CSV"""
+        diff = list_diff(options, api_get_list(options))
+        batches = trakt_client.prefetch(trakt_metrics.timed('build_payload', trakt_client.batches(diff.to_add(data), options.batch_size), len))
+        for result in send_batches(options, results, batches, api_add_to_list, dead_letter=dead_letter):
+            sum_results(options, results, result)
+        remove_results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0, 'failed' : 0}
+        to_remove = [{'ids': diff.items[key]} for key in diff.to_remove()]
+        for result in send_batches(options, remove_results, trakt_client.batches(to_remove, options.batch_size), api_remove_from_list):
+            sum_results(options, remove_results, result)
+        diff_removed(options, remove_results)
+
+async def async_import(options, data, results, journal=None, dead_letter=None, found=None):
+        """
+        Cleanup and import with the asyncio engine, several batches in flight
+        With --retry 'data' are the rows of the dead-letter CSV, looked up concurrently first
+        """
+        async with trakt_async.Client(_trakt['baseurl'], _headers, options.concurrency) as client:
+            if options.retry:
+                data = import_items(options, await async_resolve_rows(options, client, data, found, dead_letter), found, dead_letter)
+            # Only send the differences with the list
+            if options.diff:
+                try:
+                    export_data = await client.api_get_list(options)
+                except trakt_client.APIError as e:
+                    print(e)
+                    export_data = None
+                diff = list_diff(options, export_data or [])
+                data = diff.to_add(data)
+            # Empty list prior to import
+            if options.clean and journal and journal.cleaned:
+                print("Resume, skip cleanup of the {list} list already emptied".format(list=options.list))
+            elif options.clean:
+                try:
+                    export_data = await client.api_get_list(options)
+                except trakt_client.APIError as e:
+                    print(e)
+                    export_data = None
+                to_remove = cleanup_ids(options, export_data or [])
+                cleanup_results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0, 'failed' : 0}
+                await trakt_async.run_bounded(
+                        send_batches(options, cleanup_results, trakt_client.batches(to_remove, options.batch_size), client.api_remove_from_list),
+                        lambda result: sum_results(options, cleanup_results, result), options.concurrency)
+                print("Overall cleanup {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
+                    sent=cleanup_results['sentids'], type=options.type,
+                    deleted=cleanup_results['deleted'], not_found=cleanup_results['not_found']))
+                if journal and not cleanup_results['failed']:
+                    journal.clean()
+            await trakt_async.run_bounded(
+                    send_batches(options, results, trakt_metrics.timed('build_payload', trakt_client.batches(data, options.batch_size), len),
+                                 client.api_add_to_list, journal, dead_letter),
+                    lambda result: sum_results(options, results, result), options.concurrency)
+            if options.diff:
+                remove_results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0, 'failed' : 0}
+                to_remove = [{'ids': diff.items[key]} for key in diff.to_remove()]
+                await trakt_async.run_bounded(
+                        send_batches(options, remove_results, trakt_client.batches(to_remove, options.batch_size), client.api_remove_from_list),
+                        lambda result: sum_results(options, remove_results, result), options.concurrency)
+                diff_removed(options, remove_results)
 
 def main():
         """
@@ -362,7 +638,7 @@ def main():
                       default=False, action='store_true', dest='rated_at')
         parser.add_argument('-f', '--format',
                       help='allow to overwrite default ID type format, default %(default)s',
-                      choices=['imdb', 'tmdb', 'tvdb', 'tvrage', 'trakt'], dest='format', default='imdb')
+                      choices=_formats, dest='format', default='imdb')
         parser.add_argument('--delimiter',
                         help='specify delimiter for CSV parsing, default is ","',
                         dest='delimiter', default=',')
@@ -379,22 +655,79 @@ def main():
         parser.add_argument('-C', '--clean',
                       help='empty list prior to import, default %(default)s',
                       default=False, action='store_true', dest='clean')
+        parser.add_argument('--diff',
+                      help='only add the items missing from the list and remove the ones not in the CSV, instead of --clean, default %(default)s',
+                      default=False, action='store_true', dest='diff')
+        parser.add_argument('--resume',
+                      help='skip the batches imported by a previous interrupted run of the same CSV, read from its journal, default %(default)s',
+                      default=False, action='store_true', dest='resume')
+        parser.add_argument('--dead-letter',
+                      help='write the items not found or in a failed batch to this CSV file, or JSONL file if it ends with .jsonl, default %(default)s',
+                      action='store', type=str, dest='dead_letter', default=None)
+        parser.add_argument('--retry',
+                      help='the CSV is a dead-letter file, look up the not found items by each of their IDs and send them again, default %(default)s',
+                      default=False, action='store_true', dest='retry')
+        parser.add_argument('-b', '--batch-size',
+                      help='number of items sent per API call, default %(default)s',
+                      type=trakt_client.positive_int, dest='batch_size', default=100)
+        parser.add_argument('--async',
+                      help='send the API calls with the asyncio engine, require aiohttp, default %(default)s',
+                      default=False, action='store_true', dest='async_engine')
+        parser.add_argument('--concurrency',
+                      help='max number of API calls in flight with --async or --translate, default %(default)s',
+                      type=trakt_client.positive_int, dest='concurrency', default=8)
+        parser.add_argument('--metrics',
+                      help='write the run metrics to this file, as Prometheus text if it ends with .prom or as JSON otherwise, default %(default)s',
+                      action='store', type=str, dest='metrics', default=None)
+        parser.add_argument('--translate',
+                      help='fill in every ID format of the CSV and write it to this file instead of importing, default %(default)s',
+                      action='store', type=str, dest='translate', default=None)
         #parser.add_argument('-d', '--dryrun',
         #              help='do not update the account, default %(default)s',
         #              default=True, action='store_true', dest='dryrun')
+        parser.add_argument('-q', '--quiet',
+                      help='do not print the progress messages, eg: the pages fetched, the lists found or the dryrun batches, only the results and errors, default %(default)s',
+                      default=False, action='store_true', dest='quiet')
         parser.add_argument('-V', '--verbose',
-                      help='print additional verbose information, default %(default)s',
-                      default=True, action='store_true', dest='verbose')
+                      help='print additional verbose information, the URLs, payloads and results of every API call, default %(default)s',
+                      default=False, action='store_true', dest='verbose')
         options = parser.parse_args()
+        trakt_client.setup_logging(options.verbose, options.quiet)
+
+        if options.metrics:
+            trakt_metrics.enable(options.metrics)
 
         # Display debug information
-        if options.verbose:
-            print("Options: %s" % options)
+        log.debug("Options: %s", options)
 
         if options.seen and options.list != "history":
             print("Error, you can only mark seen {0} when adding into the history list".format(options.type))
             sys.exit(1)
 
+        if options.diff and options.list not in ['watchlist', 'collection']:
+            print("Error, you can only sync the differences with the watchlist or collection list")
+            sys.exit(1)
+
+        if options.diff and options.clean:
+            print("Error, --diff and --clean can not be used together")
+            sys.exit(1)
+
+        if options.resume and (options.diff or options.translate):
+            print("Error, --resume can not be used with --diff or --translate")
+            sys.exit(1)
+
+        if options.retry and (options.diff or options.clean or options.translate):
+            print("Error, --retry can not be used with --diff, --clean or --translate")
+            sys.exit(1)
+
+        if options.dead_letter and os.path.abspath(options.dead_letter) == os.path.abspath(options.input.name):
+            print("Error, the dead-letter file can not be the CSV file")
+            sys.exit(1)
+
+        if options.async_engine and not trakt_async.available():
+            print("Error, the asyncio engine require the module aiohttp")
+            sys.exit(1)
+
         if options.seen:
             try:
                 datetime.datetime.strptime(options.seen, '%Y-%m-%dT%H:%M:%S.000Z')
@@ -405,8 +738,7 @@ def main():
         config = read_config(options)
 
         ## Display debug information
-        if options.verbose:
-            print("Config: {}".format(config))
+        log.debug("Config: %s", config)
 
         ## Trakt auth
         if not _trakt['access_token'] and not _trakt['refresh_token'] and \
@@ -438,81 +770,85 @@ def main():
             sys.exit(1)
 
         ## Display debug information
-        if options.verbose:
-            print("Trakt: {}".format(_trakt))
-            print("Authorization header: {}".format(_headers['Authorization']))
-            print("trakt-api-key header: {}".format(_headers['trakt-api-key']))
-
-        # Empty list prior to import
-        if options.clean:
-            cleanup_list(options)
-
-        # Read CSV list of IDs
-        read_ids = read_csv(options)
-
-        # if IDs make the list into trakt format
-        data = []
-        results = {'sentids' : 0, 'added' : 0, 'existing' : 0, 'not_found' : 0}
-        if read_ids:
-            print("Found {0} items to import".format(len(read_ids)))
-
-            for myid in read_ids:
-                # If id (row) exists and is not blank (has a format)
-                if myid and not options.format in myid:
-                    print("Invalid file format, id (row) must exists and is not blank (has a format).")
+        log.debug("Trakt: %s", _trakt)
+        log.debug("Authorization header: %s", _headers['Authorization'])
+        log.debug("trakt-api-key header: %s", _headers['trakt-api-key'])
+
+        # Translate the IDs of the CSV into every format and stop
+        if options.translate:
+            translate_csv(options)
+            if options.verbose:
+                trakt_client.print_stats()
+            sys.exit(0)
+
+        # Read CSV list of IDs and make the list into trakt format, row by row
+        found = {'rows' : 0, 'lookups' : 0, 'resolved' : 0, 'unresolved' : 0}
+        # Items not imported, as they happen
+        dead_letter = None
+        if options.dead_letter:
+            dead_letter = trakt_journal.DeadLetter(options.dead_letter, options.delimiter)
+        rows = trakt_metrics.timed('read_csv', read_csv(options))
+        if options.retry and options.async_engine:
+            # Looked up by the asyncio engine
+            data = rows
+        elif options.retry:
+            data = import_items(options, resolve_rows(options, rows, found, dead_letter), found, dead_letter)
+        else:
+            data = import_items(options, rows, found, dead_letter)
+        results = {'sentids' : 0, 'added' : 0, 'existing' : 0, 'not_found' : 0, 'failed' : 0}
+        # Progress journal of the batches, next to the CSV file
+        journal = None
+        if not options.diff and not options.input.name.startswith('<'):
+            try:
+                journal = trakt_journal.Journal(options.input.name + '.journal', options.resume)
+            except OSError as e:
+                if options.resume:
+                    print("Error, can not read the journal to resume: {0}".format(e))
                     sys.exit(1)
-                if myid and myid[options.format]:
-                    #pp.pprint(myid)
-                    # If format is not "imdb" it must be cast to an integer
-                    if not options.format == "imdb" and not myid[options.format].startswith('tt'):
-                        myid[options.format] = int(myid[options.format])
-                    if (options.type == "movies" or options.type == "shows") and options.seen:
-                        data.append({'ids':{options.format : myid[options.format]}, "watched_at": options.seen})
-                    elif (options.type == "movies" or options.type == "shows") and options.watched_at:
-                        data.append({'ids':{options.format : myid[options.format]}, "watched_at": myid["watched_at"]})
-                    elif options.type == "episodes" and options.seen:
-                        data.append({'ids':{options.format : myid[options.format]},"watched_at": options.seen})
-                    elif options.type == "episodes" and options.watched_at:
-                        data.append({'ids':{options.format : myid[options.format]},"watched_at": myid["watched_at"]})
-                    elif (options.type == "movies" or options.type == "shows") and options.list == 'ratings' and options.rated_at:
-                        data.append({'ids':{options.format : myid[options.format]}, "rated_at": myid["rated_at"], "rating": myid["rating"]})
-                    else:
-                        data.append({'ids':{options.format : myid[options.format]}})
-                    # Import batch of 10 IDs
-                    if len(data) >= 10:
-                        #pp.pprint(json.dumps(data))
-                        results['sentids'] += len(data)
-                        result = api_add_to_list(options, data)
-                        if result:
-                            print("Result: {0}".format(result))
-                            if 'added' in result and result['added']:
-                                results['added'] += result['added'][options.type]
-                            if 'existing' in result and result['existing']:
-                                results['existing'] += result['existing'][options.type]
-                            if 'not_found' in result and result['not_found']:
-                                results['not_found'] += len(result['not_found'][options.type])
-                        data = []
-            # Import the rest
-            if len(data) > 0:
-                #pp.pprint(data)
-                results['sentids'] += len(data)
-                result = api_add_to_list(options, data)
-                if result:
-                    print("Result: {0}".format(result))
-                    if 'added' in result and result['added']:
-                        results['added'] += result['added'][options.type]
-                    if 'existing' in result and result['existing']:
-                        results['existing'] += result['existing'][options.type]
-                    if 'not_found' in result and result['not_found']:
-                        results['not_found'] += len(result['not_found'][options.type])
+                log.warning("Warning, can not write the journal, the import can not be resumed: %s", e)
+            if journal and options.resume:
+                print("Resume from the journal {0}, {1} batches already done".format(journal.path, len(journal.done)))
+        if options.async_engine:
+            asyncio.run(async_import(options, data, results, journal, dead_letter, found))
+        elif options.diff:
+            diff_list(options, data, results, dead_letter)
         else:
+            # Empty list prior to import
+            if options.clean:
+                cleanup_list(options, journal)
+            # Batches are built in a background thread while the previous one is uploaded
+            batches = trakt_client.prefetch(trakt_metrics.timed('build_payload', trakt_client.batches(data, options.batch_size), len))
+            for result in send_batches(options, results, batches, api_add_to_list, journal, dead_letter):
+                sum_results(options, results, result)
+        if journal:
+            # Keep the journal to resume the failed batches
+            journal.close(remove=not results['failed'])
+        if dead_letter:
+            dead_letter.close()
+        if options.retry:
+            print("Retry, resolved {resolved} out of {count} not found items with {lookups} lookups, still not found:{unresolved}".format(
+                    resolved=found['resolved'], count=found['resolved'] + found['unresolved'],
+                    lookups=found['lookups'], unresolved=found['unresolved']))
+        if found['rows'] == 0:
             # TODO Read STDIN to ID
             print("No items found, nothing to do.")
             sys.exit(0)
+        print("Found {0} items to import".format(found['rows']))
 
         print("Overall imported {sent} {type}, results added:{added}, existing:{existing}, not_found:{not_found}".format(
                 sent=results['sentids'], type=options.type, added=results['added'],
                 existing=results['existing'], not_found=results['not_found']))
+        if journal and journal.skipped:
+            print("Resume, skipped {0} batches imported by a previous run".format(journal.skipped))
+        if journal and results['failed']:
+            print("{failed} batches failed, run again with --resume to retry them".format(failed=results['failed']))
+        if dead_letter and dead_letter.count:
+            print("Wrote {count} items not imported to {path}, run again on it with --retry".format(
+                    count=dead_letter.count, path=dead_letter.path))
+
+        ## Display HTTP latency stats
+        if options.verbose:
+            trakt_client.print_stats()
 
 if __name__ == '__main__':
         main()
@@ -26,19 +26,28 @@ import sys, os
 try:
         import simplejson as json
         import requests
-        requests.packages.urllib3.disable_warnings()
         import tmdbsimple as tmdb
 except:
         sys.exit("Please use your favorite mehtod to install the following module requests and simplejson and tmdbsimple to use this script")
 
+import trakt_client
+import trakt_cache
+import trakt_journal
+import trakt_metrics
+import tmdb_filter
+
 import argparse
 import configparser
+import concurrent.futures
 import datetime
 import collections
+import logging
 import pprint
+import threading
 import time
 
 pp = pprint.PrettyPrinter(indent=4)
+log = logging.getLogger(__name__)
 
 desc="""This program sync TMDB discovery into a Trakt.tv list."""
 
@@ -57,8 +66,17 @@ _trakt = {
 _tmdb = {
         'apikey'     :       '', # Auth details for TMDB API key
         'filter'     :       '', # Auth details for TMDB discover filter
+        'predicates' :       tmdb_filter._defaults, # Filter of the discover results, languages, votes, dates, genres
 }
 
+# TMDB API rate limit, about 50 requests per second per IP, keep some margin
+_tmdb_limiter = trakt_client.TokenBucket(40, 40)
+_tmdb_session = None
+_tmdb_lock = threading.Lock()
+
+# TMDB discover only serves the first 500 pages
+_tmdb_max_pages = 500
+
 _headers = {
         'Accept'            : 'application/json',   # required per API
         'Content-Type'      : 'application/json',   # required per API
@@ -69,18 +87,9 @@ _headers = {
         'Authorization'     : '',                   # required per API
 }
 
-_proxy = {
-        'proxy' : False,                # True or False, trigger proxy use
-        'host'  : 'https://127.0.0.1',  # Host/IP of the proxy
-        'port'  : '3128'                # Port of the proxy
-}
-
-_proxyDict = {
-        "http" : _proxy['host']+':'+_proxy['port'],
-        "https" : _proxy['host']+':'+_proxy['port']
-}
-
-response_arr = []
+def job_print(args, message):
+        """Print a line of a job output, prefixed with its list name as the jobs run concurrently"""
+        print("[{0}] {1}".format(args.list, message))
 
 def read_config(args):
         """
@@ -95,8 +104,7 @@ def read_config(args):
         _configfile = os.path.join(work_dir, args.config)
         if os.path.exists(args.config):
                 _configfile = args.config
-        if args.verbose:
-                print("Config file: {0}".format(_configfile))
+        log.debug("Config file: %s", _configfile)
         if os.path.exists(_configfile):
                 try:
                         config = configparser.ConfigParser()
@@ -110,6 +118,7 @@ def read_config(args):
                                 _tmdb['filter'] = config.get('TMDB','FILTER')
                         else:
                                 print('Warning, no filter found. default filter will apply')
+                        _tmdb['predicates'] = tmdb_filter.read_config(config, 'TMDB')
                         if config.has_option('TRAKT','CLIENT_ID') and len(config.get('TRAKT','CLIENT_ID')) != 0:
                                 _trakt['client_id'] = config.get('TRAKT','CLIENT_ID')
                         else:
@@ -130,13 +139,8 @@ def read_config(args):
                                 print('Warning, no refresh token found. Authentification is required')
                         if config.has_option('TRAKT','BASEURL'):
                                 _trakt['baseurl'] = config.get('TRAKT','BASEURL')
-                        if config.has_option('SETTINGS','PROXY'):
-                                _proxy['proxy'] = config.getboolean('SETTINGS','PROXY')
-                        if _proxy['proxy'] and config.has_option('SETTINGS','PROXY_HOST') and config.has_option('SETTINGS','PROXY_PORT'):
-                                _proxy['host'] = config.get('SETTINGS','PROXY_HOST')
-                                _proxy['port'] = config.get('SETTINGS','PROXY_PORT')
-                                _proxyDict['http'] = _proxy['host']+':'+_proxy['port']
-                                _proxyDict['https'] = _proxy['host']+':'+_proxy['port']
+                        trakt_client.read_config(config)
+                        trakt_cache.read_config(config)
                         return config
                 except:
                         print("Error reading configuration file {0}".format(_configfile))
@@ -158,6 +162,8 @@ def read_config(args):
                         config.set('SETTINGS', 'PROXY', False)
                         config.set('SETTINGS', 'PROXY_HOST', 'https://127.0.0.1')
                         config.set('SETTINGS', 'PROXY_PORT', '3128')
+                        config.set('SETTINGS', 'POOL_SIZE', '10')
+                        config.set('SETTINGS', 'MAX_PAYLOAD', '1048576')
                         with open(_configfile, 'w') as configfile:
                                 config.write(configfile)
                                 print("Default settings wrote to file {0}".format(_configfile))
@@ -165,12 +171,49 @@ def read_config(args):
                         print("Error writing configuration file {0}".format(_configfile))
                 sys.exit(1)
 
+def tmdb_api_discover_page(args, kwargs, page):
+        """
+        TMDB API call for one page of the discover, retry when throttled by a 429
+        """
+        kwargs = dict(kwargs, page=page)
+        throttled = 0
+        while True:
+            try:
+                # Discover keep the last response as attributes, one instance per call
+                if args.type == "movies":
+                    response = tmdb.Discover().movie(**kwargs)
+                else:
+                    response = tmdb.Discover().tv(**kwargs)
+                break
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 429 or throttled >= trakt_client._settings['max_throttled']:
+                    raise
+                throttled += 1
+                wait = trakt_client.retry_after(e.response.headers)
+                log.warning("[%s] TMDB rate limit exceeded, retry %d of %d in %s seconds", args.list,
+                            throttled, trakt_client._settings['max_throttled'], wait)
+                _tmdb_limiter.pause(wait)
+        log.debug("TMDB fetched page %s of %s pages", response['page'], response['total_pages'])
+        return response
+
 def tmdb_api_discover(args):
-        """TMDB API call to discover movie from the filter"""
+        """
+        TMDB API call to discover movie from the filter
+        The page count is read from the first page, the next pages are fetched in
+        parallel by a bounded pool and merged in page order
+        """
         # https://developers.themoviedb.org/3/discover/movie-discover
-        tmdb.API_KEY = _tmdb['apikey']
-        discover = tmdb.Discover()
-        if not _tmdb['filter']:
+        global _tmdb_session
+        # Keep-alive connections, throttled by the TMDB rate limiter, answered from the response cache if possible
+        with _tmdb_lock:
+            if _tmdb_session is None:
+                _tmdb_session = trakt_client.new_session(trakt_client.CachingSession)
+                _tmdb_session.name = 'TMDB'
+                _tmdb_session.limiter = _tmdb_limiter
+                tmdb.API_KEY = _tmdb['apikey']
+                tmdb.REQUESTS_SESSION = _tmdb_session
+                tmdb.REQUESTS_TIMEOUT = trakt_client._settings['timeout']
+        if not args.filter:
             kwargs = {  "page": 1,
                         "vote_average.gte": 6,
                         "primary_release_year": datetime.datetime.today().year,
@@ -180,24 +223,17 @@ def tmdb_api_discover(args):
                         "include_video": "false"
                     }
         else:
-            kwargs = json.loads(_tmdb['filter'])
-        if args.verbose:
-            print("TMDB filter {}".format(kwargs))
-        if args.type == "movies":
-            response = discover.movie(**kwargs)
-        else:
-            response = discover.tv(**kwargs)
-        if args.verbose:
-            print("TMDB fetched page {page} of {total} pages".format(total=response['total_pages'], page=response['page']))
-        print("TMDB found {total} items".format(total=response['total_results']))
+            kwargs = json.loads(args.filter)
+        log.debug("TMDB filter %s", kwargs)
+        response = tmdb_api_discover_page(args, kwargs, kwargs.get('page', 1))
+        job_print(args, "TMDB found {total} items".format(total=response['total_results']))
         results = response['results']
-        while int(response['page']) < int(response['total_pages']):
-            # Increment page
-            kwargs['page'] = response['page']+1
-            response = discover.movie(**kwargs)
-            if args.verbose:
-                print("TMDB fetched page {page} of {total} pages".format(total=response['total_pages'], page=response['page']))
-            results += response['results']
+        pages = range(int(response['page']) + 1, min(int(response['total_pages']), _tmdb_max_pages) + 1)
+        if pages:
+            workers = max(1, min(trakt_client._settings['workers'], len(pages)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for response in executor.map(lambda page: tmdb_api_discover_page(args, kwargs, page), pages):
+                    results += response['results']
         return results
 
 def api_auth(options, config=None, refresh=False):
@@ -230,7 +266,7 @@ def api_auth(options, config=None, refresh=False):
             }
 
         url = _trakt['baseurl'] + '/oauth/token'
-        request = requests.post(url, data=values)
+        request = trakt_client.post(url, data=values)
         if request.status_code == 200:
             response = request.json()
             #pp.pprint(response)
@@ -253,12 +289,8 @@ def api_auth(options, config=None, refresh=False):
 def api_user(args):
         """API call for settings / Get username"""
         url = _trakt['baseurl'] + '/users/settings'
-        if args.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        r = trakt_client.get(url, headers=_headers, cache=True)
         #pp.pprint(r.headers)
         if r.status_code != 200:
             print("Error fetching user settings: {status} [{text}]".format(
@@ -268,14 +300,10 @@ def api_user(args):
             return json.loads(r.text)
 
 def api_get_lists(args):
-        """API call for Sync / Get list for username"""
+        """API call for Sync / Get list for username, not cached as it checks the list slugs exist"""
         url = _trakt['baseurl'] + '/users/{username}/lists'.format(username=_trakt['username'])
-        if args.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        r = trakt_client.get(url, headers=_headers)
         #pp.pprint(r.headers)
         if r.status_code != 200:
             print("Error fetching Get {list}: {status} [{text}]".format(
@@ -288,15 +316,11 @@ def api_get_items_from_list(args):
         """API call for Sync / Get items in list for username"""
         url = _trakt['baseurl'] + '/users/{username}/lists/{id}/items/{type}'.format(
                                 username=_trakt['username'], id=args.list, type=args.type)
-        if args.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        r = trakt_client.get(url, headers=_headers)
         #pp.pprint(r.headers)
         if r.status_code != 200:
-            print("Error fetching Get {list}: {status} [{text}]".format(
+            job_print(args, "Error fetching Get {list}: {status} [{text}]".format(
                     list=args.list, status=r.status_code, text=r.text))
             return None
         else:
@@ -304,22 +328,16 @@ def api_get_items_from_list(args):
 
 def api_add_items_to_list(args, import_data):
         """API call for Sync / Add items to custom user list"""
-        # 429 [AUTHED_API_POST_LIMIT rate limit exceeded. Please wait 1 seconds then retry your request.]
-        # Rate limit for API
-        time.sleep(1)
         url = _trakt['baseurl'] + '/users/{username}/lists/{id}/items'.format(
                                 username=_trakt['username'], id=args.list)
         values = { args.type : import_data }
         json_data = json.dumps(values)
-        if args.verbose:
-            print("Sending to URL: {0}".format(url))
-            pp.pprint(json_data)
-        if _proxy['proxy']:
-            r = requests.post(url, data=json_data, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.post(url, data=json_data, headers=_headers, timeout=(5, 60))
+        log.debug("Sending to URL: %s", url)
+        log.debug("%s", json_data)
+        # Custom list items are unique, sending twice is harmless
+        r = trakt_client.post(url, data=json_data, headers=_headers, idempotent=True)
         if r.status_code != 201:
-            print("Error Adding items to {list}: {status} [{text}]".format(
+            job_print(args, "Error Adding items to {list}: {status} [{text}]".format(
                     list=args.list, status=r.status_code, text=r.text))
             return None
         else:
@@ -334,96 +352,239 @@ def api_remove_from_list(args, remove_data):
         else:
             values = { args.type : remove_data }
         json_data = json.dumps(values)
-        if args.verbose:
-            print(url)
-            pp.pprint(json_data)
-        if _proxy['proxy']:
-            r = requests.post(url, data=json_data, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.post(url, data=json_data, headers=_headers, timeout=(5, 60))
+        log.debug("%s", url)
+        log.debug("%s", json_data)
+        # Custom list items are unique, sending twice is harmless
+        r = trakt_client.post(url, data=json_data, headers=_headers, idempotent=True)
         if r.status_code != 200:
-            print("Error removing items from {list}: {status} [{text}]".format(
+            job_print(args, "Error removing items from {list}: {status} [{text}]".format(
                     list=args.list, status=r.status_code, text=r.text))
             return None
         else:
             return json.loads(r.text)
 
-def api_get_history_list(args, page):
-        """API call for Sync / Get list by type"""
-        url = _trakt['baseurl'] + '/sync/history/{type}?page={page}&limit={limit}'.format(
-                            type=args.type, page=page, limit=1000)
-        if args.verbose:
-            print(url)
-        if _proxy['proxy']:
-            r = requests.get(url, headers=_headers, proxies=_proxyDict, timeout=(10, 60))
-        else:
-            r = requests.get(url, headers=_headers, timeout=(5, 60))
-        #pp.pprint(r.headers)
-        if r.status_code != 200:
-            print("Error fetching Get {list}: {status} [{text}]".format(
-                    list=args.list, status=r.status_code, text=r.text))
-            return None
-        else:
-            global response_arr
-            response_arr += json.loads(r.text)
-        if 'X-Pagination-Page-Count'in r.headers and r.headers['X-Pagination-Page-Count']:
-            print("Fetched page {page} of {PageCount} pages for history list".format(
-                    page=page, PageCount=r.headers['X-Pagination-Page-Count']))
-            if page != int(r.headers['X-Pagination-Page-Count']):
-                api_get_history_list(args, page+1)
+def api_get_history_list(args):
+        """API call for Sync / Get list by type, iterate over the items page by page"""
+        url = _trakt['baseurl'] + '/sync/history/{type}'.format(type=args.type)
+        log.debug("%s", url)
+        return trakt_client.iter_pages(url, 'history', headers=_headers)
 
-        return response_arr
+def watched_index(args):
+        """
+        Return the set of tmdb IDs of the watched items
+        The history is read from its snapshot while it is fresh, else it is fetched and saved
+        """
+        name = 'sync/history/{type}'.format(type=args.type)
+        store = trakt_cache.snapshots()
+        items = store.get(name, trakt_cache._settings['watched_ttl']) if store else None
+        if items is not None:
+            print("Found {len} items in the history snapshot for user '{username}'".format(
+                                len=len(items), username=_trakt['username']))
+        else:
+            log.info("Fetching history list from trakt.tv for user '%s'", _trakt['username'])
+            try:
+                items = trakt_cache.index_items(data[args.type[:-1]]['ids'] for data in api_get_history_list(args))
+            except trakt_client.APIError as e:
+                print(e)
+                print("Error, no history return from trakt.tv for user '{0}'".format(_trakt['username']))
+                sys.exit(1)
+            if store:
+                store.replace(name, items)
+        # Items without a tmdb ID can not match a TMDB discover result
+        return set(ids['tmdb'] for ids in items.values() if ids.get('tmdb'))
 
 def cleanup_list(args):
         """Empty list prior to import"""
         export_data = api_get_items_from_list(args)
         #pp.pprint(export_data)
         if export_data:
-            print("Found {len} items from the '{list}' list for user '{username}'".format(
+            job_print(args, "Found {len} items from the '{list}' list for user '{username}'".format(
                 len=len(export_data), list=args.list, username=_trakt['username']))
         else:
-            print("Warning, Cleanup no '{type}' items return from the '{list}' list for user '{username}'".format(
+            job_print(args, "Warning, Cleanup no '{type}' items return from the '{list}' list for user '{username}'".format(
                 type=args.type, list=args.list, username=_trakt['username']))
             return
 
         results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0}
-        to_remove = []
-        for data in export_data:
-            to_remove.append({'ids': data[args.type[:-1]]['ids']})
-            if len(to_remove) >= 10:
-                results['sentids'] += len(to_remove)
-                result = api_remove_from_list(args, to_remove)
-                if result:
-                    print("Result: {0}".format(result))
-                    if 'deleted' in result and result['deleted']:
-                        results['deleted'] += result['deleted'][args.type]
-                    if 'not_found' in result and result['not_found']:
-                        results['not_found'] += len(result['not_found'][args.type])
-                to_remove = []
-        # Remove the rest
-        if len(to_remove) > 0:
-            #print pp.pprint(data)
-            results['sentids'] += len(to_remove)
-            result = api_remove_from_list(args, to_remove)
+        to_remove = ({'ids': data[args.type[:-1]]['ids']} for data in export_data)
+        for batch in trakt_client.batches(to_remove, args.batch_size):
+            results['sentids'] += len(batch)
+            result = api_remove_from_list(args, batch)
             if result:
-                print("Result: {0}".format(result))
+                log.debug("Result: %s", result)
                 if 'deleted' in result and result['deleted']:
                     results['deleted'] += result['deleted'][args.type]
                 if 'not_found' in result and result['not_found']:
                     results['not_found'] += len(result['not_found'][args.type])
-        print("Overall cleanup {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
+        job_print(args, "Overall cleanup {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
             sent=results['sentids'], type=args.type, deleted=results['deleted'], not_found=results['not_found']))
 
+def diff_list(args):
+        """
+        Return the diff against the items of the list, always fetched so the items
+        added or removed on trakt.tv since the previous run are reconciled
+        Return None if the list could not be fetched
+        """
+        export_data = api_get_items_from_list(args)
+        if export_data is None:
+            job_print(args, "Error, no '{type}' items return from the '{list}' list for user '{username}'".format(
+                type=args.type, list=args.list, username=_trakt['username']))
+            return None
+        job_print(args, "Found {len} items from the '{list}' list for user '{username}'".format(
+            len=len(export_data), list=args.list, username=_trakt['username']))
+        return trakt_cache.ListDiff(trakt_cache.index_items(data[args.type[:-1]]['ids'] for data in export_data))
+
+def remove_diff(args, diff, removed):
+        """Remove the list items not discovered anymore"""
+        results = {'sentids' : 0, 'deleted' : 0, 'not_found' : 0}
+        to_remove = [{'ids': diff.items[key]} for key in removed]
+        for batch in trakt_client.batches(to_remove, args.batch_size):
+            results['sentids'] += len(batch)
+            if not args.dryrun:
+                result = api_remove_from_list(args, batch)
+                if result:
+                    log.debug("Result: %s", result)
+                    if 'deleted' in result and result['deleted']:
+                        results['deleted'] += result['deleted'][args.type]
+                    if 'not_found' in result and result['not_found']:
+                        results['not_found'] += len(result['not_found'][args.type])
+            else:
+                log.info("[%s] Dryrun, skip remove trakt.tv items from the list for user '%s'", args.list, _trakt['username'])
+        job_print(args, "Overall removed {sent} {type}, results deleted:{deleted}, not_found:{not_found}".format(
+            sent=results['sentids'], type=args.type, deleted=results['deleted'], not_found=results['not_found']))
+
+def read_jobs(args, config):
+        """
+        Return the jobs of the run, a copy of the args for each trakt.tv list to sync
+        With --jobs one per [JOB name] section of the config file, with its LIST, FILTER and TYPE,
+        else the one of the command line with the [TMDB] FILTER
+        """
+        jobs = []
+        if args.jobs:
+            for section in config.sections():
+                if not section.startswith('JOB'):
+                    continue
+                job = argparse.Namespace(**vars(args))
+                job.list = config.get(section, 'LIST', fallback=section[3:].strip())
+                job.type = config.get(section, 'TYPE', fallback=args.type)
+                job.filter = config.get(section, 'FILTER', fallback=_tmdb['filter'])
+                job.predicates = tmdb_filter.read_config(config, section, _tmdb['predicates'])
+                if job.type not in ['movies', 'shows']:
+                    print("Error, invalid TYPE '{0}' in the [{1}] section, movies or shows".format(job.type, section))
+                    sys.exit(1)
+                jobs.append(job)
+            if not jobs:
+                print("Error, no [JOB name] section found in the config file")
+                sys.exit(1)
+        else:
+            job = argparse.Namespace(**vars(args))
+            job.filter = _tmdb['filter']
+            job.predicates = _tmdb['predicates']
+            jobs.append(job)
+        return jobs
+
+def sync_list(args, watched, dead_letter=None):
+        """
+        Sync the TMDB discover of a job into its trakt.tv list
+        * Cleanup list from Trakt.tv
+        * Get data from TMDB
+        * Reduce TMDB list to the filter predicates and if need not watched
+        * Inject data into Trakt.tv
+        The items not imported are written to the dead letter if any
+        Return the import results, None if the TMDB discover or the trakt.tv list returned nothing
+        """
+        # Empty trakt.tv list prior to import
+        if args.mode == 'diff':
+            pass
+        elif args.clean and not args.dryrun:
+            cleanup_list(args)
+        else:
+            log.info("[%s] Dryrun, skip cleanup the trakt.tv list for user '%s'", args.list, _trakt['username'])
+
+        # Get discover data from TMDB
+        log.info("[%s] Fetching %s from TMDB", args.list, args.type)
+        start = time.perf_counter()
+        discover_data = tmdb_api_discover(args)
+        trakt_metrics.stage('discover', len(discover_data or []), time.perf_counter() - start)
+        if discover_data:
+            job_print(args, "Found {len} {type} from the TMDB discover".format(len=len(discover_data), type=args.type))
+        else:
+            job_print(args, "Error, no {type} return from the TMDB discover for trakt.tv list slug '{list}'".format(
+                                            type=args.type, list=args.list))
+            return None
+
+        # Reduce to the languages, votes, dates and genres of the filter and if need not watched
+        start = time.perf_counter()
+        new_discover_data, removed = tmdb_filter.filter_items(discover_data, args.predicates,
+                                                              watched if args.skipwatched else None)
+        trakt_metrics.stage('filter', len(discover_data), time.perf_counter() - start)
+        for name, count in sorted(removed.items()):
+            log.info("[%s] Filter %s, removed %d %s", args.list, name, count, args.type)
+        job_print(args, "Filter, removed {0} {type} and reduce to {1} out of {2} {type} from the TMDB discover".format(
+                    len(discover_data) - len(new_discover_data), len(new_discover_data), len(discover_data), type=args.type))
+        discover_data = new_discover_data
+
+        # if discover data generate the list into trakt format
+        data = []
+        results = {'sentids' : 0, 'added' : 0, 'existing' : 0, 'not_found' : 0, 'failed' : 0}
+        if discover_data:
+            job_print(args, "Found {0} items to import in trakt.tv list slug '{1}' for user '{2}'".format(
+                                            len(discover_data), args.list, _trakt['username']))
+            for discover in discover_data:
+                if discover['id']:
+                    if args.seen:
+                        data.append({'ids':{'tmdb': discover['id']}, 'watched_at': args.seen})
+                    else:
+                        data.append({'ids':{'tmdb': discover['id']}})
+        # Only keep the differences with the trakt.tv list, keyed on the tmdb ID
+        # even with nothing left to add, the items not discovered anymore are removed
+        # but an empty discover is more likely a bad filter than an empty list wanted
+        if args.mode == 'diff':
+            diff = diff_list(args)
+            if diff is None:
+                return None
+            wanted = len(data)
+            data = list(diff.to_add(data))
+            removed = diff.to_remove()
+            if not wanted and removed:
+                job_print(args, "Warning, no item left to sync, skip removing the {remove} items of trakt.tv list slug '{list}'".format(
+                                        remove=len(removed), list=args.list))
+                removed = []
+            job_print(args, "Diff, {add} items to add and {remove} items to remove in trakt.tv list slug '{list}'".format(
+                                        add=len(data), remove=len(removed), list=args.list))
+        # Import by batch of IDs
+        for batch in trakt_client.batches(data, args.batch_size):
+            results['sentids'] += len(batch)
+            if not args.dryrun:
+                start = time.perf_counter()
+                result = api_add_items_to_list(args, batch)
+                trakt_metrics.stage('post', len(batch), time.perf_counter() - start)
+                if dead_letter:
+                    dead_letter.record(args, batch, result)
+                if result:
+                    log.debug("Result: %s", result)
+                    if 'added' in result and result['added']:
+                        results['added'] += result['added'][args.type]
+                    if 'existing' in result and result['existing']:
+                        results['existing'] += result['existing'][args.type]
+                    if 'not_found' in result and result['not_found']:
+                        results['not_found'] += len(result['not_found'][args.type])
+                else:
+                    results['failed'] += 1
+            else:
+                log.info("[%s] Dryrun, skip import trakt.tv items into the list for user '%s'", args.list, _trakt['username'])
+        if args.mode == 'diff':
+            remove_diff(args, diff, removed)
+
+        return results
+
 def main():
         """
         Main program loop
         * Read configuration file and validate
-        * Find trakt.tv custom user list
+        * Find trakt.tv custom user lists of the jobs
         * Fetch watched in trakt.tv history list
-        * Cleanup list from Trakt.tv
-        * Get data from TMDB
-        * Reduce TMDB list to only my langauge fr, en, es and if need watched
-        * Inject data into Trakt.tv
+        * Sync each job TMDB discover into its list, concurrently
         """
         ## Parse inputs if any
         parser = argparse.ArgumentParser(description=desc, epilog=epilog)
@@ -444,20 +605,41 @@ def main():
         parser.add_argument('-C', '--clean',
                       help='empty trakt.tv list prior to import, default %(default)s',
                       default=False, action='store_true', dest='clean')
+        parser.add_argument('-m', '--mode',
+                      help='refill: add every discovered item, after --clean if set; diff: only add the missing items and remove the ones not discovered anymore, default %(default)s',
+                      choices=['refill', 'diff'], dest='mode', default='refill')
         parser.add_argument('-d', '--dryrun',
                       help='do not update the account, default %(default)s',
                       default=False, action='store_true', dest='dryrun')
+        parser.add_argument('-b', '--batch-size',
+                      help='number of items sent per API call, default %(default)s',
+                      type=trakt_client.positive_int, dest='batch_size', default=100)
+        parser.add_argument('-j', '--jobs',
+                      help='sync every [JOB name] section of the config file, each with its LIST, FILTER and TYPE, instead of --list, default %(default)s',
+                      default=False, action='store_true', dest='jobs')
+        parser.add_argument('--dead-letter',
+                      help='write the items not found or in a failed batch to this CSV file, or JSONL file if it ends with .jsonl, default %(default)s',
+                      action='store', type=str, dest='dead_letter', default=None)
         parser.add_argument('--skipwatched',
                       help='skip watched items from trakt.tv, default %(default)s',
                       default=True, action='store_true', dest='skipwatched')
+        parser.add_argument('--metrics',
+                      help='write the run metrics to this file, as Prometheus text if it ends with .prom or as JSON otherwise, default %(default)s',
+                      action='store', type=str, dest='metrics', default=None)
+        parser.add_argument('-q', '--quiet',
+                      help='do not print the progress messages, eg: the pages fetched, the lists found or the dryrun batches, only the results and errors, default %(default)s',
+                      default=False, action='store_true', dest='quiet')
         parser.add_argument('-V', '--verbose',
-                      help='print additional verbose information, default %(default)s',
-                      default=True, action='store_true', dest='verbose')
+                      help='print additional verbose information, the URLs, payloads and results of every API call, default %(default)s',
+                      default=False, action='store_true', dest='verbose')
         args = parser.parse_args()
+        trakt_client.setup_logging(args.verbose, args.quiet)
+
+        if args.metrics:
+            trakt_metrics.enable(args.metrics)
 
         ## Display debug information
-        if args.verbose:
-            print("Args: %s" % args)
+        log.debug("Args: %s", args)
 
         if args.seen:
             try:
@@ -465,12 +647,15 @@ def main():
             except:
                 sys.exit("Error, invalid format, it's must be UTC datetime, eg: '2016-01-01T00:00:00.000Z'")
 
+        if args.mode == 'diff' and args.clean:
+            print("Error, --clean can not be used with the diff mode")
+            sys.exit(1)
+
         ## Read configuration and validate
         config = read_config(args)
 
         ## Display debug information
-        if args.verbose:
-            print("Config: {}".format(config))
+        log.debug("Config: %s", config)
 
         ## Trakt auth
         if not _trakt['access_token'] and not _trakt['refresh_token'] and \
@@ -502,11 +687,10 @@ def main():
             sys.exit(1)
 
         ## Display debug information
-        if args.verbose:
-            print("API Trakt: {}".format(_trakt))
-            print("Authorization header: {}".format(_headers['Authorization']))
-            print("trakt-api-key header: {}".format(_headers['trakt-api-key']))
-            print("API TMDB: {}".format(_tmdb))
+        log.debug("API Trakt: %s", _trakt)
+        log.debug("Authorization header: %s", _headers['Authorization'])
+        log.debug("trakt-api-key header: %s", _headers['trakt-api-key'])
+        log.debug("API TMDB: %s", _tmdb)
 
         # Find trakt.tv username/slug
         if not _trakt['username']:
@@ -520,118 +704,69 @@ def main():
                 print("Error, trakt.tv user slug not found for user")
                 sys.exit(1)
 
+        # Jobs of the run, one per trakt.tv list
+        jobs = read_jobs(args, config)
+
         # Find trakt.tv custom user list
-        if args.list:
-            print("Fetching custom list from trakt.tv for user '{0}'".format(_trakt['username']))
-            slug_list = []
-            track_lists = api_get_lists(args)
-            for track_list in track_lists:
-                print("List slug '{0}' name '{1}'".format(track_list['ids']['slug'], track_list['name']))
-                slug_list.append(track_list['ids']['slug'])
-            #pp.pprint(slug_list)
-            if args.list in slug_list:
-                print("Found trakt.tv list slug '{0}'".format(args.list))
+        log.info("Fetching custom list from trakt.tv for user '%s'", _trakt['username'])
+        slug_list = []
+        track_lists = api_get_lists(args)
+        for track_list in track_lists:
+            log.info("List slug '%s' name '%s'", track_list['ids']['slug'], track_list['name'])
+            slug_list.append(track_list['ids']['slug'])
+        #pp.pprint(slug_list)
+        for job in jobs:
+            if job.list in slug_list:
+                log.info("Found trakt.tv list slug '%s'", job.list)
             else:
                 print("Error, trakt.tv list slug '{0}' not found for user '{1}'".format(
-                                                        args.list, _trakt['username']))
+                                                        job.list, _trakt['username']))
                 sys.exit(1)
 
-        # Fetch watched in trakt.tv history list
+        # Fetch watched in trakt.tv history list, once per type
+        watched = {}
         if args.skipwatched:
-            watched = []
-            print("Fetching history list from trakt.tv for user '{0}'".format(_trakt['username']))
-            history_data = api_get_history_list(args, 1)
-            for data in history_data:
-                watched.append(int(data[args.type[:-1]]['ids']['tmdb']))
-            print("Found {len} items in history list from trakt.tv for user '{username}'".format(
-                                len=len(watched), username=_trakt['username']))
-
-        # Empty trakt.tv list prior to import
-        if args.clean and not args.dryrun:
-            cleanup_list(args)
-        else:
-            print("Dryrun, skip cleanup trakt.tv list slug '{0}' for user '{1}'".format(
-                                                        args.list, _trakt['username']))
-
-        # Get discover data from TMDB
-        print("Fetching {type} from TMDB".format(type=args.type))
-        discover_data = tmdb_api_discover(args)
-        if discover_data:
-            print("Found {len} {type} from the TMDB discover".format(len=len(discover_data), type=args.type))
-        else:
-            print("Error, no {type} return from the TMDB discover".format(type=args.type))
-            sys.exit(1)
-
-        # Reduce to only my language fr, en, es and if need watched
-        skip = 0
-        new_discover_data = []
-        for movie in discover_data:
-            if movie["original_language"] != "en" and \
-                movie["original_language"] != "es" and \
-                movie["original_language"] != "fr":
-                    print("Skip language {lang} movie '{title}'".format(title=movie['original_title'].encode('utf-8'),
-                                                                    lang=movie['original_language']))
-                    skip += 1
+            for job in jobs:
+                if job.type not in watched:
+                    watched[job.type] = watched_index(job)
+                    print("Found {len} items in history list from trakt.tv for user '{username}'".format(
+                                len=len(watched[job.type]), username=_trakt['username']))
+
+        # Items not imported by any job, as they happen
+        dead_letter = None
+        if args.dead_letter:
+            dead_letter = trakt_journal.DeadLetter(args.dead_letter)
+
+        # Run the jobs concurrently, they share the rate limiters
+        # a job failing is reported and counted, the other jobs still run
+        failed = 0
+        workers = max(1, min(trakt_client._settings['workers'], len(jobs)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(job, executor.submit(sync_list, job, watched.get(job.type), dead_letter)) for job in jobs]
+            for job, future in futures:
+                try:
+                    results = future.result()
+                except Exception as e:
+                    log.debug("[%s] Job failed", job.list, exc_info=True)
+                    job_print(job, "Error, sync of trakt.tv list slug '{list}' failed: {error}".format(list=job.list, error=e))
+                    results = None
+                if results is None:
+                    failed += 1
                     continue
-            if args.skipwatched and watched and (movie['id'] in watched):
-                print("Skip watched movie '{title}' ".format(title=movie['original_title'].encode('utf-8')))
-                skip += 1
-                continue
-            new_discover_data.append(movie)
-        print("Filter, removed {0} movies and reduce to {1} out of {2} movies from the TMDB discover".format(
-                                            skip, len(new_discover_data), len(discover_data)))
-        discover_data = new_discover_data
-
-        # if discover data generate the list into trakt format
-        data = []
-        results = {'sentids' : 0, 'added' : 0, 'existing' : 0, 'not_found' : 0}
-        if discover_data:
-            print("Found {0} items to import in trakt.tv list slug '{1}' for user '{2}'".format(
-                                            len(discover_data), args.list, _trakt['username']))
-            for discover in discover_data:
-                if discover['id']:
-                    if args.seen:
-                        data.append({'ids':{'tmdb': discover['id']}, 'watched_at': args.seen})
-                    else:
-                        data.append({'ids':{'tmdb': discover['id']}})
-                    # Import batch of 10 IDs
-                    if len(data) >= 10:
-                        results['sentids'] += len(data)
-                        if not args.dryrun:
-                            result = api_add_items_to_list(args, data)
-                            if result:
-                                print("Result: {0}".format(result))
-                                if 'added' in result and result['added']:
-                                    results['added'] += result['added'][args.type]
-                                if 'existing' in result and result['existing']:
-                                    results['existing'] += result['existing'][args.type]
-                                if 'not_found' in result and result['not_found']:
-                                    results['not_found'] += len(result['not_found'][args.type])
-                        else:
-                            print("Dryrun, skip import trakt.tv items into list slug '{0}' for user '{1}'".format(
-                                                        args.list, _trakt['username']))
-                        data = []
-            # Import the rest
-            if len(data) > 0:
-                #print pp.pprint(data)
-                results['sentids'] += len(data)
-                if not args.dryrun:
-                    result = api_add_items_to_list(args, data)
-                    if result:
-                        print("Result: {0}".format(result))
-                        if 'added' in result and result['added']:
-                            results['added'] += result['added'][args.type]
-                        if 'existing' in result and result['existing']:
-                            results['existing'] += result['existing'][args.type]
-                        if 'not_found' in result and result['not_found']:
-                            results['not_found'] += len(result['not_found'][args.type])
-                else:
-                    print("Dryrun, skip import trakt.tv items into list slug '{0}' for user '{1}'".format(
-                                                        args.list, _trakt['username']))
+                job_print(job, "Overall imported {sent} {type} in trakt.tv list slug '{list}', results added:{added}, existing:{existing}, not_found:{not_found}".format(
+                        sent=results['sentids'], type=job.type, list=job.list, added=results['added'],
+                        existing=results['existing'], not_found=results['not_found']))
+        if dead_letter:
+            dead_letter.close()
+            if dead_letter.count:
+                print("Wrote {count} items not imported to {path}".format(count=dead_letter.count, path=dead_letter.path))
+
+        ## Display HTTP latency stats
+        if args.verbose:
+            trakt_client.print_stats()
 
-        print("Overall imported {sent} {type}, results added:{added}, existing:{existing}, not_found:{not_found}".format(
-                sent=results['sentids'], type=args.type, added=results['added'], 
-                existing=results['existing'], not_found=results['not_found']))
+        if failed:
+            sys.exit(1)
 
 if __name__ == '__main__':
         main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Tests of the dead-letter file and of the --retry pass over it
+# Run with: python3 -m unittest test_trakt_journal
+#
+
+import argparse
+import collections
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import import_trakt
+import trakt_journal
+
+class DeadLetterRetryTest(unittest.TestCase):
+
+        def setUp(self):
+            fd, self.path = tempfile.mkstemp(suffix='.csv')
+            os.close(fd)
+            self.options = argparse.Namespace(format='imdb', type='movies', list='history', retry=False,
+                                              seen=False, watched_at=True, rated_at=False)
+
+        def tearDown(self):
+            os.remove(self.path)
+
+        def dead_letter_rows(self, rows, result):
+            """Import the CSV rows as one batch with the Trakt 'result' and return the dead-letter rows"""
+            found = collections.Counter()
+            dead_letter = trakt_journal.DeadLetter(self.path)
+            batch = list(import_trakt.import_items(self.options, rows, found, dead_letter))
+            dead_letter.record(self.options, batch, result)
+            dead_letter.close()
+            with open(self.path, 'r', encoding = 'utf-8', newline='') as fp:
+                return list(csv.DictReader(fp))
+
+        def test_not_found_row_keeps_every_id(self):
+            rows = [{'imdb' : 'tt1000404', 'tmdb' : '555', 'watched_at' : '2020-01-01T00:00:00.000Z'},
+                    {'imdb' : 'tt1000405', 'tmdb' : '556', 'watched_at' : '2020-01-02T00:00:00.000Z'}]
+            # Trakt only echoes the ids block that was sent
+            result = {'added' : {'movies' : 1}, 'not_found' : {'movies' : [{'ids' : {'imdb' : 'tt1000404'}}]}}
+            dead = self.dead_letter_rows(rows, result)
+            self.assertEqual(len(dead), 1)
+            self.assertEqual(dead[0]['imdb'], 'tt1000404')
+            self.assertEqual(dead[0]['tmdb'], '555')
+            self.assertEqual(dead[0]['watched_at'], '2020-01-01T00:00:00.000Z')
+            self.assertEqual(dead[0]['reason'], 'not_found')
+
+        def test_retry_finds_row_by_its_second_id(self):
+            rows = [{'imdb' : 'tt1000404', 'tmdb' : '555', 'watched_at' : '2020-01-01T00:00:00.000Z'}]
+            result = {'added' : {'movies' : 0}, 'not_found' : {'movies' : [{'ids' : {'imdb' : 'tt1000404'}}]}}
+            dead = self.dead_letter_rows(rows, result)
+
+            def search(options, id, id_type=None):
+                if id_type == 'tmdb' and str(id) == '555':
+                    return [{'type' : 'movie', 'movie' : {'ids' : {'trakt' : 42, 'tmdb' : 555}}}]
+                return []
+
+            self.options.retry = True
+            found = collections.Counter()
+            with mock.patch.object(import_trakt, 'api_search_by_id', side_effect=search) as api:
+                items = list(import_trakt.import_items(self.options,
+                                                       import_trakt.resolve_rows(self.options, dead, found), found))
+            self.assertEqual([call.args[2] for call in api.call_args_list], ['imdb', 'tmdb'])
+            self.assertEqual(found['resolved'], 1)
+            self.assertEqual(items, [{'ids' : {'trakt' : 42}, 'watched_at' : '2020-01-01T00:00:00.000Z'}])
+
+if __name__ == '__main__':
+        unittest.main()
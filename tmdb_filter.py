@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Filter stage of the TMDB discover results
+# The results are loaded into columns and every predicate is evaluated over a
+# whole column at once with numpy, or item by item without it
+#
+# Requirement
+# pip3 install numpy (optional)
+#
+
+try:
+        import numpy
+except ImportError:
+        numpy = None
+
+# Predicates applied to the discover results, in this order
+_defaults = {
+        'languages'        : set(['en', 'es', 'fr']), # Original languages kept, empty to keep every language
+        'min_vote_average' : None,      # Minimum vote_average
+        'min_vote_count'   : None,      # Minimum vote_count
+        'released_after'   : None,      # First release date kept, YYYY-MM-DD
+        'released_before'  : None,      # Last release date kept, YYYY-MM-DD
+        'with_genres'      : set(),     # Keep the items with at least one of these genre IDs
+        'without_genres'   : set(),     # Drop the items with any of these genre IDs
+}
+
+def available():
+        """True if the predicates are evaluated with numpy"""
+        return numpy is not None
+
+def read_config(config, section, defaults=None):
+        """
+        Read the predicates from a section of the config file
+        LANGUAGES, WITH_GENRES and WITHOUT_GENRES are comma separated lists
+        The options missing from the section keep the given defaults
+        """
+        predicates = dict(defaults or _defaults)
+        if config.has_option(section, 'LANGUAGES'):
+                predicates['languages'] = set(lang.strip() for lang in config.get(section, 'LANGUAGES').split(',') if lang.strip())
+        if config.has_option(section, 'MIN_VOTE_AVERAGE'):
+                predicates['min_vote_average'] = config.getfloat(section, 'MIN_VOTE_AVERAGE')
+        if config.has_option(section, 'MIN_VOTE_COUNT'):
+                predicates['min_vote_count'] = config.getint(section, 'MIN_VOTE_COUNT')
+        if config.has_option(section, 'RELEASED_AFTER'):
+                predicates['released_after'] = config.get(section, 'RELEASED_AFTER') or None
+        if config.has_option(section, 'RELEASED_BEFORE'):
+                predicates['released_before'] = config.get(section, 'RELEASED_BEFORE') or None
+        if config.has_option(section, 'WITH_GENRES'):
+                predicates['with_genres'] = set(int(genre) for genre in config.get(section, 'WITH_GENRES').split(',') if genre.strip())
+        if config.has_option(section, 'WITHOUT_GENRES'):
+                predicates['without_genres'] = set(int(genre) for genre in config.get(section, 'WITHOUT_GENRES').split(',') if genre.strip())
+        return predicates
+
+def release_date(item):
+        """Release date of a movie or first air date of a show, '' if unknown"""
+        return item.get('release_date') or item.get('first_air_date') or ''
+
+def column(items, name):
+        """Load one field the predicates need into a numpy column"""
+        if name == 'id':
+            return numpy.array([item.get('id') or 0 for item in items], dtype=numpy.int64)
+        if name == 'language':
+            return numpy.array([item.get('original_language') or '' for item in items], dtype=str)
+        if name in ('vote_average', 'vote_count'):
+            return numpy.array([item.get(name) or 0 for item in items], dtype=numpy.float64)
+        if name == 'release_date':
+            return numpy.array([release_date(item) for item in items], dtype=str)
+
+def genre_columns(items):
+        """Load the genre IDs flattened into a numpy column, with the row of each genre ID alongside"""
+        genres = [item.get('genre_ids') or [] for item in items]
+        return (numpy.array([genre for ids in genres for genre in ids], dtype=numpy.int64),
+                numpy.repeat(numpy.arange(len(items)), [len(ids) for ids in genres]))
+
+def any_genre(genre_cols, genres, count):
+        """Mask of the rows having at least one of the genre IDs"""
+        genre, genre_row = genre_cols
+        return numpy.bincount(genre_row[numpy.isin(genre, list(genres))], minlength=count) > 0
+
+def masks(items, predicates, watched):
+        """
+        Yield the name and the keep mask of each active predicate, evaluated over whole columns
+        Only the columns of the active predicates are loaded
+        """
+        count = len(items)
+        if predicates['languages']:
+            yield 'language', numpy.isin(column(items, 'language'), list(predicates['languages']))
+        if predicates['min_vote_average'] is not None:
+            yield 'vote_average', column(items, 'vote_average') >= predicates['min_vote_average']
+        if predicates['min_vote_count'] is not None:
+            yield 'vote_count', column(items, 'vote_count') >= predicates['min_vote_count']
+        if predicates['released_after'] or predicates['released_before']:
+            dates = column(items, 'release_date')
+            if predicates['released_after']:
+                yield 'released_after', (dates != '') & (dates >= predicates['released_after'])
+            if predicates['released_before']:
+                yield 'released_before', (dates != '') & (dates <= predicates['released_before'])
+        if predicates['with_genres'] or predicates['without_genres']:
+            genre_cols = genre_columns(items)
+            if predicates['with_genres']:
+                yield 'with_genres', any_genre(genre_cols, predicates['with_genres'], count)
+            if predicates['without_genres']:
+                yield 'without_genres', ~any_genre(genre_cols, predicates['without_genres'], count)
+        if watched:
+            yield 'watched', ~numpy.isin(column(items, 'id'), numpy.fromiter(watched, dtype=numpy.int64, count=len(watched)))
+
+def keep(item, predicates, watched):
+        """Return the name of the first predicate the item fails, None if it is kept"""
+        if predicates['languages'] and item.get('original_language') not in predicates['languages']:
+            return 'language'
+        if predicates['min_vote_average'] is not None and (item.get('vote_average') or 0) < predicates['min_vote_average']:
+            return 'vote_average'
+        if predicates['min_vote_count'] is not None and (item.get('vote_count') or 0) < predicates['min_vote_count']:
+            return 'vote_count'
+        date = release_date(item)
+        if predicates['released_after'] and (not date or date < predicates['released_after']):
+            return 'released_after'
+        if predicates['released_before'] and (not date or date > predicates['released_before']):
+            return 'released_before'
+        genres = set(item.get('genre_ids') or [])
+        if predicates['with_genres'] and not genres & predicates['with_genres']:
+            return 'with_genres'
+        if predicates['without_genres'] and genres & predicates['without_genres']:
+            return 'without_genres'
+        if watched and item.get('id') in watched:
+            return 'watched'
+        return None
+
+def filter_items(items, predicates, watched=None):
+        """
+        Return the items passing every predicate, in their original order, and the
+        number of items removed by each predicate, an item counts for the first one it fails
+        'watched' is a set of tmdb IDs to remove
+        """
+        removed = dict()
+        if not items:
+            return [], removed
+        if numpy is not None:
+            kept = numpy.ones(len(items), dtype=bool)
+            for name, mask in masks(items, predicates, watched):
+                count = int(numpy.count_nonzero(kept & ~mask))
+                if count:
+                    removed[name] = count
+                kept &= mask
+            return [items[i] for i in numpy.flatnonzero(kept)], removed
+        result = []
+        for item in items:
+            name = keep(item, predicates, watched)
+            if name is None:
+                result.append(item)
+            else:
+                removed[name] = removed.get(name, 0) + 1
+        return result, removed
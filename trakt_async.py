@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Optional asyncio engine for the Trakt.tv tools
+# Overlap in-flight requests up to a concurrency limit, without a thread per request
+# Used by import_trakt.py --async: list fetch, add, remove and ID lookups
+#
+# Requirement
+# pip3 install aiohttp
+#
+
+import sys
+import asyncio
+import logging
+import time
+try:
+        import simplejson as json
+except:
+        sys.exit("Please use your favorite method to install the following module simplejson to use this script")
+try:
+        import aiohttp
+except ImportError:
+        aiohttp = None
+
+import trakt_client
+import trakt_cache
+import trakt_metrics
+
+log = logging.getLogger(__name__)
+
+def available():
+        """True if the asyncio engine can be used, aiohttp is installed"""
+        return aiohttp is not None
+
+class Client(object):
+        """
+        Asyncio Trakt API client
+        At most 'concurrency' requests are in flight, all of them go through
+        the GET and POST rate limiters shared with trakt_client
+        """
+        def __init__(self, baseurl, headers, concurrency=8):
+            if aiohttp is None:
+                sys.exit("Please use your favorite method to install the following module aiohttp to use the async engine")
+            self.baseurl = baseurl
+            self.headers = headers
+            self.semaphore = asyncio.Semaphore(concurrency)
+            self.session = None
+
+        async def __aenter__(self):
+            if trakt_client._proxy['proxy']:
+                connect, read = trakt_client._settings['proxy_timeout']
+            else:
+                connect, read = trakt_client._settings['timeout']
+            self.session = aiohttp.ClientSession(
+                        connector=aiohttp.TCPConnector(limit=trakt_client._settings['pool_size']),
+                        timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+            return self
+
+        async def __aexit__(self, *exc):
+            await self.session.close()
+
+        async def request(self, method, url, idempotent=None, **kwargs):
+            """
+            Send a request once the rate limiter allows it, retry when throttled by a 429
+            Retry the transient failures as trakt_client does, a POST only if 'idempotent'
+            Return the HTTP status, the headers and the body text
+            """
+            if idempotent is None:
+                idempotent = method == 'GET'
+            if trakt_client._proxy['proxy']:
+                kwargs.setdefault('proxy', trakt_client._proxyDict['https'])
+            bucket = trakt_client.limiter(method)
+            throttled = 0
+            attempt = 0
+            async with self.semaphore:
+                while True:
+                    wait = bucket.reserve()
+                    if wait > 0:
+                        trakt_metrics.count('rate_limit_wait_seconds', wait)
+                        await asyncio.sleep(wait)
+                    start = time.perf_counter()
+                    try:
+                        async with self.session.request(method, url, headers=self.headers, **kwargs) as r:
+                            body = await r.read()
+                            text = body.decode(r.get_encoding())
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        trakt_metrics.observe(method, url, time.perf_counter() - start, type(e).__name__)
+                        wait = trakt_client.retry_wait(url, attempt, type(e).__name__,
+                                                       not isinstance(e, aiohttp.ClientConnectorError), idempotent)
+                        if wait is None:
+                            raise
+                        attempt += 1
+                        await asyncio.sleep(wait)
+                        continue
+                    finally:
+                        trakt_client.record(method, time.perf_counter() - start)
+                    trakt_metrics.observe(method, url, time.perf_counter() - start, r.status,
+                                          len(kwargs.get('data') or ''), len(body))
+                    trakt_client.update_limiter(bucket, r.headers)
+                    if r.status in trakt_client._transient:
+                        wait = trakt_client.retry_wait(url, attempt, 'HTTP {0}'.format(r.status), True, idempotent)
+                        if wait is not None:
+                            attempt += 1
+                            await asyncio.sleep(wait)
+                            continue
+                    if r.status != 429 or throttled >= trakt_client._settings['max_throttled']:
+                        break
+                    throttled += 1
+                    trakt_metrics.count('throttled')
+                    wait = trakt_client.retry_after(r.headers)
+                    log.warning("Rate limit exceeded, retry %d of %d in %s seconds: %s",
+                                throttled, trakt_client._settings['max_throttled'], wait, url)
+                    bucket.pause(wait)
+            return r.status, r.headers, text
+
+        async def get_page(self, url, page, name, limit=1000):
+            """API call for one page of a paginated list, return the items and the page count"""
+            status, headers, text = await self.request('GET', url, params={'page' : page, 'limit' : limit})
+            if status != 200:
+                raise trakt_client.APIError("Error fetching Get {name} page {page}: {status} [{text}]".format(
+                        name=name, page=page, status=status, text=text))
+            page_count = 1
+            if headers.get('X-Pagination-Page-Count'):
+                page_count = int(headers['X-Pagination-Page-Count'])
+                log.info("Fetched page %d of %d pages for %s list", page, page_count, name)
+            return json.loads(text), page_count
+
+        async def get_pages(self, url, name, limit=1000):
+            """API call for every page of a paginated list, the pages after the first one are fetched concurrently"""
+            items, page_count = await self.get_page(url, 1, name, limit)
+            pages = await asyncio.gather(*[self.get_page(url, page, name, limit)
+                                           for page in range(2, page_count + 1)])
+            for page_items, page_count in pages:
+                items += page_items
+            return items
+
+        async def api_get_list(self, options):
+            """API call for Sync / Get list by type"""
+            url = self.baseurl + '/sync/{list}/{type}'.format(list=options.list, type=options.type)
+            return await self.get_pages(url, options.list)
+
+        async def api_search_by_id(self, options, id, id_type=None):
+            """API call for Search / ID Lookup / Get ID lookup results, answered from the ID cache when possible"""
+            if id_type is None:
+                id_type = options.format
+            cache = trakt_cache.ids()
+            if cache:
+                results = cache.get(id_type, id)
+                if results is not None:
+                    return results
+            url = self.baseurl + '/search'
+            status, headers, text = await self.request('GET', url, params={'id_type' : id_type, 'id' : id})
+            if status != 200:
+                print("Error Get ID lookup results: {0} [{1}]".format(status, text))
+                return None
+            results = json.loads(text)
+            if cache:
+                cache.set(id_type, id, results)
+            return results
+
+        async def api_add_to_list(self, options, import_data):
+            """API call for Sync / Add items to list"""
+            url = self.baseurl + '/sync/{list}'.format(list=options.list)
+            values = { options.type : import_data }
+            start = time.perf_counter()
+            json_data = json.dumps(values)
+            trakt_metrics.stage('build_payload', 0, time.perf_counter() - start)
+            # Adding twice is harmless except to the history, where each add is a new play
+            start = time.perf_counter()
+            status, headers, text = await self.request('POST', url, idempotent=options.list != 'history',
+                                                       data=json_data)
+            trakt_metrics.stage('post', len(import_data), time.perf_counter() - start)
+            if status != 201:
+                print("Error Adding items to {list}: {status} [{text}]".format(
+                        list=options.list, status=status, text=text))
+                return None
+            start = time.perf_counter()
+            result = json.loads(text)
+            trakt_metrics.stage('parse', len(import_data), time.perf_counter() - start)
+            return result
+
+        async def api_remove_from_list(self, options, remove_data):
+            """API call for Sync / Remove from list"""
+            url = self.baseurl + '/sync/{list}/remove'.format(list=options.list)
+            if options.type == 'episodes':
+                values = { 'shows' : remove_data }
+            else:
+                values = { options.type : remove_data }
+            status, headers, text = await self.request('POST', url, idempotent=True, data=json.dumps(values))
+            if status != 200:
+                print("Error removing items from {list}: {status} [{text}]".format(
+                        list=options.list, status=status, text=text))
+                return None
+            return json.loads(text)
+
+async def run_bounded(calls, handle, concurrency):
+        """
+        Await the coroutines produced by 'calls' with at most 'concurrency' of them pending,
+        so a streamed input is never fully loaded, and pass each result to 'handle'
+        """
+        pending = set()
+        for call in calls:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    handle(task.result())
+            pending.add(asyncio.ensure_future(call))
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            for task in done:
+                handle(task.result())
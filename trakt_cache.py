@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Persistent on-disk cache for the Trakt.tv tools
+# ID lookup results are kept in a SQLite database keyed on (id_type, id)
+# Snapshots of the Trakt lists are kept in the same database, so a list can be
+# synced by sending only the differences
+# Cacheable GET responses are kept there too, with their ETag/Last-Modified for revalidation
+#
+
+import sys
+import sqlite3
+import threading
+import time
+try:
+        import simplejson as json
+except:
+        sys.exit("Please use your favorite method to install the following module simplejson to use this script")
+
+_settings = {
+        'path'          : 'trakt_cache.db', # SQLite database file, empty to disable the cache
+        'ttl'           : 30*24*60*60,      # Seconds before a found ID is looked up again
+        'negative_ttl'  : 24*60*60,         # Seconds before a not found ID is looked up again
+        'watched_ttl'   : 6*60*60,          # Seconds the history snapshot is trusted to skip the watched items
+        'response_ttl'  : 60*60,            # Seconds a cached GET response is used without asking the API
+}
+
+_ids = None
+_ids_lock = threading.Lock()
+_snapshots = None
+_responses = None
+
+def read_config(config):
+        """Read the cache settings from the SETTINGS section"""
+        if config.has_option('SETTINGS','CACHE_PATH'):
+                _settings['path'] = config.get('SETTINGS','CACHE_PATH')
+        if config.has_option('SETTINGS','CACHE_TTL'):
+                _settings['ttl'] = config.getint('SETTINGS','CACHE_TTL')
+        if config.has_option('SETTINGS','CACHE_NEGATIVE_TTL'):
+                _settings['negative_ttl'] = config.getint('SETTINGS','CACHE_NEGATIVE_TTL')
+        if config.has_option('SETTINGS','WATCHED_TTL'):
+                _settings['watched_ttl'] = config.getint('SETTINGS','WATCHED_TTL')
+        if config.has_option('SETTINGS','RESPONSE_TTL'):
+                _settings['response_ttl'] = config.getint('SETTINGS','RESPONSE_TTL')
+
+class IDCache(object):
+        """
+        ID lookup cache, thread safe
+        Store the search results with their ids block (trakt/slug/imdb/tmdb/tvdb),
+        an empty result is kept as a negative entry with its own TTL
+        """
+        def __init__(self, path, ttl, negative_ttl):
+            self.ttl = ttl
+            self.negative_ttl = negative_ttl
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS ids (
+                                id_type TEXT NOT NULL,
+                                id TEXT NOT NULL,
+                                found INTEGER NOT NULL,
+                                results TEXT NOT NULL,
+                                updated REAL NOT NULL,
+                                PRIMARY KEY (id_type, id))""")
+            self.db.commit()
+
+        def get(self, id_type, id):
+            """Return the cached search results, [] for a known not found ID, None if missing or expired"""
+            with self.lock:
+                row = self.db.execute("SELECT found, results, updated FROM ids WHERE id_type = ? AND id = ?",
+                                      (id_type, str(id))).fetchone()
+            if row is None:
+                return None
+            found, results, updated = row
+            ttl = self.ttl if found else self.negative_ttl
+            if time.time() - updated > ttl:
+                return None
+            return json.loads(results)
+
+        def set(self, id_type, id, results):
+            """Store the search results of one ID, the score is not kept"""
+            results = [dict((k, v) for k, v in result.items() if k != 'score') for result in results or []]
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO ids (id_type, id, found, results, updated) VALUES (?, ?, ?, ?, ?)",
+                                (id_type, str(id), 1 if results else 0, json.dumps(results), time.time()))
+                self.db.commit()
+
+        def close(self):
+            with self.lock:
+                self.db.close()
+
+def ids():
+        """Return the shared ID cache, open it on first use, None if the cache is disabled"""
+        global _ids
+        with _ids_lock:
+            if _ids is None and _settings['path']:
+                _ids = IDCache(_settings['path'], _settings['ttl'], _settings['negative_ttl'])
+            return _ids
+
+def id_keys(ids):
+        """Return every 'id_type:id' key an item can be matched on"""
+        return ['{0}:{1}'.format(id_type, id) for id_type, id in ids.items() if id]
+
+def item_key(ids):
+        """Return the snapshot key of an item, its trakt ID when known"""
+        if ids.get('trakt'):
+            return 'trakt:{0}'.format(ids['trakt'])
+        keys = sorted(id_keys(ids))
+        return keys[0] if keys else None
+
+def index_items(items_ids):
+        """Return the ids blocks of a list keyed on their snapshot key"""
+        return dict((item_key(ids), ids) for ids in items_ids if item_key(ids))
+
+class ListSnapshot(object):
+        """
+        Snapshot of the items of Trakt lists, thread safe
+        Each item is stored as its ids block under its snapshot key, a snapshot
+        older than the TTL is not returned and the list must be fetched again
+        """
+        def __init__(self, path, ttl):
+            self.ttl = ttl
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                                name TEXT PRIMARY KEY,
+                                updated REAL NOT NULL)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS snapshot_items (
+                                name TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                ids TEXT NOT NULL,
+                                PRIMARY KEY (name, key))""")
+            self.db.commit()
+
+        def get(self, name, ttl=None):
+            """Return the items of the list keyed on their snapshot key, None if missing or older than the TTL"""
+            if ttl is None:
+                ttl = self.ttl
+            with self.lock:
+                row = self.db.execute("SELECT updated FROM snapshots WHERE name = ?", (name,)).fetchone()
+                if row is None or time.time() - row[0] > ttl:
+                    return None
+                rows = self.db.execute("SELECT key, ids FROM snapshot_items WHERE name = ?", (name,)).fetchall()
+            return dict((key, json.loads(ids)) for key, ids in rows)
+
+        def replace(self, name, items):
+            """Store the items of a freshly fetched list"""
+            with self.lock:
+                self.db.execute("DELETE FROM snapshot_items WHERE name = ?", (name,))
+                self.db.executemany("INSERT OR REPLACE INTO snapshot_items (name, key, ids) VALUES (?, ?, ?)",
+                                    [(name, key, json.dumps(ids)) for key, ids in items.items()])
+                self.db.execute("INSERT OR REPLACE INTO snapshots (name, updated) VALUES (?, ?)", (name, time.time()))
+                self.db.commit()
+
+        def close(self):
+            with self.lock:
+                self.db.close()
+
+class ListDiff(object):
+        """
+        Set difference between the items of a list and the desired items
+        A desired item matching any ID of a list item is kept, the ones matching
+        nothing are added and the list items never matched are removed
+        """
+        def __init__(self, items):
+            self.items = items
+            self.index = {}
+            for key, ids in items.items():
+                for id_key in id_keys(ids):
+                    self.index[id_key] = key
+            self.kept = set()
+
+        def to_add(self, data):
+            """Iterate over the desired items missing from the list"""
+            for item in data:
+                keys = [self.index[id_key] for id_key in id_keys(item['ids']) if id_key in self.index]
+                if keys:
+                    self.kept.add(keys[0])
+                else:
+                    yield item
+
+        def to_remove(self):
+            """Return the keys of the list items not desired, once every desired item went through to_add"""
+            return [key for key in self.items if key not in self.kept]
+
+class ResponseCache(object):
+        """
+        HTTP response cache, thread safe
+        Store the headers and the body of a GET response under its request key,
+        with the time it was last fetched or revalidated
+        """
+        def __init__(self, path):
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                headers TEXT NOT NULL,
+                                body BLOB NOT NULL,
+                                updated REAL NOT NULL)""")
+            self.db.commit()
+
+        def get(self, key):
+            """Return the cached response as a dict with its headers, body and age in seconds, None if missing"""
+            with self.lock:
+                row = self.db.execute("SELECT headers, body, updated FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            headers, body, updated = row
+            return {'headers' : json.loads(headers), 'body' : bytes(body), 'age' : time.time() - updated}
+
+        def set(self, key, headers, body):
+            """Store a response freshly fetched"""
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO responses (key, headers, body, updated) VALUES (?, ?, ?, ?)",
+                                (key, json.dumps(headers), sqlite3.Binary(body), time.time()))
+                self.db.commit()
+
+        def touch(self, key):
+            """Mark a response as fresh again, after the API answered 304 Not Modified"""
+            with self.lock:
+                self.db.execute("UPDATE responses SET updated = ? WHERE key = ?", (time.time(), key))
+                self.db.commit()
+
+        def close(self):
+            with self.lock:
+                self.db.close()
+
+def responses():
+        """Return the shared response cache, open it on first use, None if the cache is disabled"""
+        global _responses
+        with _ids_lock:
+            if _responses is None and _settings['path']:
+                _responses = ResponseCache(_settings['path'])
+            return _responses
+
+def snapshots():
+        """Return the shared list snapshot store, open it on first use, None if the cache is disabled"""
+        global _snapshots
+        with _ids_lock:
+            if _snapshots is None and _settings['path']:
+                _snapshots = ListSnapshot(_settings['path'], _settings['watched_ttl'])
+            return _snapshots
@@ -0,0 +1,593 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Shared HTTP client for the Trakt.tv tools
+# One pooled requests.Session reused by import, export and sync scripts
+# Requests are throttled by a token bucket per GET and POST budget
+# Transient failures are retried with exponential backoff and jitter, within a retry budget per run
+#
+
+import sys
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import logging
+import queue
+import random
+import threading
+import time
+import urllib.parse
+try:
+        import simplejson as json
+        import requests
+        import requests.adapters
+        import requests.structures
+        requests.packages.urllib3.disable_warnings()
+except:
+        sys.exit("Please use your favorite method to install the following module requests and simplejson to use this script")
+
+import trakt_cache
+import trakt_metrics
+
+_proxy = {
+        'proxy' : False,                # True or False, trigger proxy use
+        'host'  : 'https://127.0.0.1',  # Host/IP of the proxy
+        'port'  : '3128'                # Port of the proxy
+}
+
+_proxyDict = {
+        "http" : _proxy['host']+':'+_proxy['port'],
+        "https" : _proxy['host']+':'+_proxy['port']
+}
+
+_settings = {
+        'pool_size'     : 10,           # Max number of keep-alive connections per host
+        'timeout'       : (5, 60),      # (connect, read) timeout without proxy
+        'proxy_timeout' : (10, 60),     # (connect, read) timeout through proxy
+        'max_throttled' : 10,           # Max number of retries of a request throttled by a 429
+        'max_retries'   : 5,            # Max number of retries of a request on a transient failure, eg: 503 or timeout
+        'retry_budget'  : 100,          # Max number of transient failure retries over the whole run
+        'backoff'       : 1.0,          # Seconds before the first retry, doubled on each retry, with jitter
+        'max_backoff'   : 60.0,         # Max seconds before a retry
+        'max_payload'   : 1048576,      # Max size in bytes of the JSON body of one sync batch
+        'workers'       : 4,            # Max number of pages fetched in parallel
+        'prefetch'      : 4,            # Max number of items produced ahead of the consumer
+}
+
+class APIError(Exception):
+        """Raised when a page of a paginated API call can not be fetched"""
+        pass
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+# HTTP status of the transient failures, the request may succeed if sent again
+_transient = (502, 503, 504)
+_retries = {'used' : 0, 'spent' : False}
+_retries_lock = threading.Lock()
+
+class TokenBucket(object):
+        """
+        Token bucket rate limiter, thread safe
+        Refill at 'rate' tokens per second up to 'capacity' tokens
+        """
+        def __init__(self, rate, capacity):
+            self.rate = float(rate)
+            self.capacity = float(capacity)
+            self.tokens = float(capacity)
+            self.updated = time.monotonic()
+            self.paused_until = 0.0
+            self.lock = threading.Lock()
+
+        def _refill(self, now):
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+        def reserve(self):
+            """Take one token and return how many seconds the caller must wait before using it"""
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                self.tokens -= 1
+                wait = 0.0
+                if self.tokens < 0:
+                    wait = -self.tokens / self.rate
+                return max(wait, self.paused_until - now)
+
+        def acquire(self):
+            """Block until a token is available"""
+            wait = self.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            return wait
+
+        def pause(self, seconds):
+            """Hold every caller for the given number of seconds, eg: on Retry-After"""
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                self.tokens = min(self.tokens, 0.0)
+                self.paused_until = max(self.paused_until, now + seconds)
+
+        def update(self, limit, period, remaining=None):
+            """Follow the limit announced by the API in the X-Ratelimit header"""
+            with self.lock:
+                self._refill(time.monotonic())
+                if limit and period:
+                    self.rate = float(limit) / float(period)
+                if remaining is not None:
+                    self.tokens = min(self.tokens, float(remaining))
+
+# Trakt API rate limits
+# AUTHED_API_GET_LIMIT 1000 calls every 5 minutes
+# AUTHED_API_POST_LIMIT 1 call per second, for POST, PUT and DELETE
+# 429 [AUTHED_API_POST_LIMIT rate limit exceeded. Please wait 1 seconds then retry your request.]
+_limiters = {
+        'GET'  : TokenBucket(1000.0 / 300, 10),
+        'POST' : TokenBucket(1, 1),
+}
+
+def setup_logging(verbose=False, quiet=False):
+        """
+        Print the log messages on stdout like the other messages, the level follows the command line
+        DEBUG with --verbose: URLs, payloads and results of every API call,
+        INFO by default: progress, eg: pages fetched, WARNING with --quiet: retries
+        The messages under the level are never formatted
+        """
+        level = logging.INFO
+        if verbose:
+            level = logging.DEBUG
+        elif quiet:
+            level = logging.WARNING
+        logging.basicConfig(stream=sys.stdout, format='%(message)s', level=level)
+        # Keep the connection pool messages out of --verbose
+        logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+def read_config(config):
+        """Read the proxy and connection pool settings from the SETTINGS section"""
+        if config.has_option('SETTINGS','PROXY'):
+                _proxy['proxy'] = config.getboolean('SETTINGS','PROXY')
+        if _proxy['proxy'] and config.has_option('SETTINGS','PROXY_HOST') and config.has_option('SETTINGS','PROXY_PORT'):
+                _proxy['host'] = config.get('SETTINGS','PROXY_HOST')
+                _proxy['port'] = config.get('SETTINGS','PROXY_PORT')
+                _proxyDict['http'] = _proxy['host']+':'+_proxy['port']
+                _proxyDict['https'] = _proxy['host']+':'+_proxy['port']
+        if config.has_option('SETTINGS','POOL_SIZE'):
+                _settings['pool_size'] = config.getint('SETTINGS','POOL_SIZE')
+        if config.has_option('SETTINGS','WORKERS'):
+                _settings['workers'] = config.getint('SETTINGS','WORKERS')
+        if config.has_option('SETTINGS','MAX_RETRIES'):
+                _settings['max_retries'] = config.getint('SETTINGS','MAX_RETRIES')
+        if config.has_option('SETTINGS','RETRY_BUDGET'):
+                _settings['retry_budget'] = config.getint('SETTINGS','RETRY_BUDGET')
+        if config.has_option('SETTINGS','MAX_PAYLOAD'):
+                _settings['max_payload'] = positive_int(config.get('SETTINGS','MAX_PAYLOAD'))
+
+def cache_key(method, url, params=None, headers=None):
+        """
+        Return the key of a request in the response cache
+        Built from the normalized URL and params, and the credentials the answer depends on
+        """
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if params:
+            query += list(params.items()) if isinstance(params, dict) else list(params)
+        query = sorted((str(k), str(v)) for k, v in query)
+        credentials = [(headers or {}).get(name, '') for name in ('Authorization', 'trakt-api-key')]
+        raw = json.dumps([method, parts.scheme, parts.netloc.lower(), parts.path, query, credentials])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def cached_response(url, entry):
+        """Rebuild a requests.Response from a response cache entry"""
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        r._content = entry['body']
+        r.encoding = 'utf-8'
+        return r
+
+def cache_lookup(method, url, kwargs):
+        """
+        Look up a GET in the response cache
+        Return the key, the entry and the cached response if it is fresh enough to skip the API,
+        for a stale entry the validators are added to the request headers in kwargs
+        """
+        store = trakt_cache.responses()
+        if store is None or method != 'GET':
+            return None, None, None
+        key = cache_key(method, url, kwargs.get('params'), kwargs.get('headers'))
+        entry = store.get(key)
+        if entry is None:
+            return key, None, None
+        if entry['age'] <= trakt_cache._settings['response_ttl']:
+            return key, entry, cached_response(url, entry)
+        validators = requests.structures.CaseInsensitiveDict(entry['headers'])
+        headers = dict(kwargs.get('headers') or {})
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+        kwargs['headers'] = headers
+        return key, entry, None
+
+def cache_store(key, entry, url, r):
+        """Keep a successful GET response in the cache, answer a 304 Not Modified from the cached entry"""
+        store = trakt_cache.responses()
+        if key is None or store is None:
+            return r
+        if r.status_code == 304 and entry:
+            store.touch(key)
+            return cached_response(url, entry)
+        if r.status_code == 200:
+            store.set(key, dict(r.headers), r.content)
+        return r
+
+class CachingSession(requests.Session):
+        """
+        requests.Session answering its GETs from the response cache, for the clients
+        that can not pass cache=True, eg: tmdbsimple
+        The requests sent are throttled by 'limiter' if set and their latency is recorded under 'name'
+        """
+        name = 'HTTP'
+        limiter = None
+
+        def request(self, method, url, **kwargs):
+            key, entry, r = cache_lookup(method, url, kwargs)
+            if r is not None:
+                record(self.name + ' cached', 0.0)
+                trakt_metrics.count('cache_hits')
+                return r
+            r = send(super(CachingSession, self).request, self.name, self.limiter,
+                     method, url, method == 'GET', **kwargs)
+            return cache_store(key, entry, url, r)
+
+def new_session(cls):
+        """Create a session with a keep-alive connection pool and the proxy settings"""
+        s = cls()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=_settings['pool_size'],
+                                                pool_maxsize=_settings['pool_size'])
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        if _proxy['proxy']:
+            s.proxies.update(_proxyDict)
+        return s
+
+def session():
+        """Return the shared requests.Session, create it on first use"""
+        global _session
+        with _session_lock:
+            if _session is None:
+                _session = new_session(requests.Session)
+            return _session
+
+def limiter(method):
+        """Return the rate limiter of the budget the HTTP method belongs to"""
+        if method == 'GET':
+            return _limiters['GET']
+        return _limiters['POST']
+
+def retry_after(headers):
+        """Number of seconds to wait from the Retry-After header, 1 second by default"""
+        try:
+            return max(float(headers.get('Retry-After', 1)), 0.0)
+        except ValueError:
+            return 1.0
+
+def update_limiter(bucket, headers):
+        """Adjust the rate limiter from the X-Ratelimit header if any"""
+        # X-Ratelimit: {"name":"AUTHED_API_GET_LIMIT","period":300,"limit":1000,"remaining":999,"until":"2021-01-01T00:05:00Z"}
+        if not headers.get('X-Ratelimit'):
+            return
+        try:
+            ratelimit = json.loads(headers['X-Ratelimit'])
+            bucket.update(ratelimit.get('limit'), ratelimit.get('period'), ratelimit.get('remaining'))
+            if ratelimit.get('remaining') == 0 and ratelimit.get('until'):
+                until = datetime.datetime.strptime(ratelimit['until'], '%Y-%m-%dT%H:%M:%SZ').replace(
+                            tzinfo=datetime.timezone.utc)
+                delay = (until - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                if delay > 0:
+                    bucket.pause(delay)
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+def reached_api(error):
+        """False if a failed request surely never reached the API, eg: connect timeout or connection refused"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return False
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return not isinstance(reason, requests.packages.urllib3.exceptions.NewConnectionError)
+
+def retry_wait(url, attempt, reason, reached, idempotent):
+        """
+        Return the seconds to wait before retrying a transient failure, None if it must not be retried
+        The wait grows exponentially with the attempt, with full jitter, and each retry is taken
+        from the budget of the run. A request which reached the API is only retried if idempotent
+        """
+        if attempt >= _settings['max_retries'] or (reached and not idempotent):
+            return None
+        with _retries_lock:
+            if _retries['used'] >= _settings['retry_budget']:
+                if not _retries['spent']:
+                    _retries['spent'] = True
+                    log.warning("Retry budget of %d retries spent, the next transient failures are not retried",
+                                _settings['retry_budget'])
+                return None
+            _retries['used'] += 1
+        trakt_metrics.count('retries')
+        wait = random.uniform(0, min(_settings['max_backoff'], _settings['backoff'] * 2 ** attempt))
+        log.warning("%s, retry %d of %d in %.1f seconds: %s", reason, attempt + 1, _settings['max_retries'], wait, url)
+        return wait
+
+def retries():
+        """Return the number of transient failure retries of the run"""
+        with _retries_lock:
+            return _retries['used']
+
+def send(send_request, name, bucket, method, url, idempotent, **kwargs):
+        """
+        Send a request with 'send_request' once the rate limiter 'bucket' allows it, record its latency under 'name'
+        Connection errors, timeouts and 502/503/504 answers are retried as told by retry_wait,
+        the last answer is returned and the last error raised
+        """
+        attempt = 0
+        while True:
+            if bucket:
+                trakt_metrics.count('rate_limit_wait_seconds', max(bucket.acquire(), 0.0))
+            start = time.perf_counter()
+            try:
+                r = send_request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                trakt_metrics.observe(method, url, time.perf_counter() - start, type(e).__name__)
+                wait = retry_wait(url, attempt, type(e).__name__, reached_api(e), idempotent)
+                if wait is None:
+                    raise
+                attempt += 1
+                time.sleep(wait)
+                continue
+            finally:
+                record(name, time.perf_counter() - start)
+            if trakt_metrics.enabled():
+                trakt_metrics.observe(method, url, time.perf_counter() - start, r.status_code,
+                                      len(r.request.body or b''), len(r.content))
+            if r.status_code not in _transient:
+                return r
+            wait = retry_wait(url, attempt, 'HTTP {0}'.format(r.status_code), True, idempotent)
+            if wait is None:
+                return r
+            attempt += 1
+            time.sleep(wait)
+
+def request(method, url, cache=False, idempotent=None, **kwargs):
+        """
+        Send a request through the shared session and record its latency
+        Wait for the rate limiter before sending, retry when throttled by a 429
+        Retry the transient failures, a POST only if 'idempotent', ie: sending it twice is harmless
+        With cache=True a GET is answered from the response cache when possible
+        """
+        if idempotent is None:
+            idempotent = method == 'GET'
+        key = entry = None
+        if cache:
+            key, entry, r = cache_lookup(method, url, kwargs)
+            if r is not None:
+                record(method + ' cached', 0.0)
+                trakt_metrics.count('cache_hits')
+                return r
+        if _proxy['proxy']:
+            kwargs.setdefault('timeout', _settings['proxy_timeout'])
+        else:
+            kwargs.setdefault('timeout', _settings['timeout'])
+        bucket = limiter(method)
+        throttled = 0
+        while True:
+            r = send(session().request, method, bucket, method, url, idempotent, **kwargs)
+            update_limiter(bucket, r.headers)
+            if r.status_code != 429 or throttled >= _settings['max_throttled']:
+                return cache_store(key, entry, url, r)
+            throttled += 1
+            trakt_metrics.count('throttled')
+            wait = retry_after(r.headers)
+            log.warning("Rate limit exceeded, retry %d of %d in %s seconds: %s", throttled, _settings['max_throttled'], wait, url)
+            bucket.pause(wait)
+
+def get(url, **kwargs):
+        """HTTP GET through the shared session"""
+        return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+        """HTTP POST through the shared session"""
+        return request('POST', url, **kwargs)
+
+def get_page(url, page, name, limit=1000, **kwargs):
+        """
+        API call for one page of a paginated list
+        Return the page items and the X-Pagination-Page-Count, None on error
+        Extra query parameters are passed in 'params'
+        """
+        params = dict(kwargs.pop('params', None) or {}, page=page, limit=limit)
+        r = get(url, params=params, **kwargs)
+        if r.status_code != 200:
+            print("Error fetching Get {name} page {page}: {status} [{text}]".format(
+                    name=name, page=page, status=r.status_code, text=r.text))
+            return None
+        page_count = 1
+        if 'X-Pagination-Page-Count' in r.headers and r.headers['X-Pagination-Page-Count']:
+            page_count = int(r.headers['X-Pagination-Page-Count'])
+            log.info("Fetched page %d of %d pages for %s list", page, page_count, name)
+        return json.loads(r.text), page_count
+
+def iter_pages(url, name, limit=1000, **kwargs):
+        """
+        Iterate over the items of every page of a paginated list, in page order
+        The page count is read from the first page, the next pages are fetched in
+        parallel by a bounded pool and yielded as soon as their turn comes
+        Raise APIError if a page can not be fetched
+        """
+        first = get_page(url, 1, name, limit, **kwargs)
+        if first is None:
+            raise APIError("Error fetching page 1 of {name} list".format(name=name))
+        items, page_count = first
+        if page_count == 0:
+            print("No pages found after API call, trakt {name} list may be empty".format(name=name))
+        for item in items:
+            yield item
+        items = first = None
+        if page_count <= 1:
+            return
+        workers = max(1, min(_settings['workers'], page_count - 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            next_page = 2
+            try:
+                while next_page <= page_count or pending:
+                    # Keep at most 'workers' pages in flight ahead of the consumer
+                    while next_page <= page_count and len(pending) < workers:
+                        pending.append((next_page, executor.submit(get_page, url, next_page, name, limit, **kwargs)))
+                        next_page += 1
+                    page, future = pending.popleft()
+                    result = future.result()
+                    if result is None:
+                        raise APIError("Error fetching page {page} of {name} list".format(page=page, name=name))
+                    for item in result[0]:
+                        yield item
+                    result = None
+            finally:
+                for page, future in pending:
+                    future.cancel()
+
+def get_pages(url, name, limit=1000, **kwargs):
+        """API call for every page of a paginated list, return the items in page order or None on error"""
+        try:
+            return list(iter_pages(url, name, limit, **kwargs))
+        except APIError as e:
+            print(e)
+            return None
+
+def positive_int(value):
+        """argparse type of the options counting items, eg: --batch-size"""
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise argparse.ArgumentTypeError("invalid positive int value: '{0}'".format(value))
+        return number
+
+def non_negative_int(value):
+        """argparse type of the options counting days or seconds back, eg: --overlap"""
+        try:
+            number = int(value)
+        except ValueError:
+            number = -1
+        if number < 0:
+            raise argparse.ArgumentTypeError("invalid non-negative int value: '{0}'".format(value))
+        return number
+
+def batches(items, size, max_bytes=None):
+        """
+        Split items into lists of at most 'size' items
+        A batch is also closed before its JSON encoding would exceed 'max_bytes'
+        """
+        if max_bytes is None:
+            max_bytes = _settings['max_payload']
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            # Item plus the ", " separator in the JSON array
+            item_bytes = len(json.dumps(item)) + 2
+            if batch and (len(batch) >= size or batch_bytes + item_bytes > max_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += item_bytes
+        if batch:
+            yield batch
+
+def prefetch(items, maxsize=None):
+        """
+        Iterate over items produced by a background thread through a bounded queue
+        The producer, eg: CSV parsing, runs ahead of the consumer, eg: upload, by at most maxsize items
+        An exception raised by the producer is raised again in the consumer
+        """
+        if maxsize is None:
+            maxsize = _settings['prefetch']
+        pipe = queue.Queue(maxsize=maxsize)
+        done = object()
+        stop = threading.Event()
+
+        def put(entry):
+            # Give up when the consumer is gone
+            while not stop.is_set():
+                try:
+                    pipe.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in items:
+                    if not put((item, None)):
+                        return
+                put((done, None))
+            except BaseException as e:
+                put((done, e))
+
+        producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item, error = pipe.get()
+                if item is done:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stop.set()
+
+def record(method, elapsed):
+        """Record the latency of one request"""
+        with _stats_lock:
+            stat = _stats.setdefault(method, {'count' : 0, 'total' : 0.0, 'min' : None, 'max' : 0.0})
+            stat['count'] += 1
+            stat['total'] += elapsed
+            if stat['min'] is None or elapsed < stat['min']:
+                stat['min'] = elapsed
+            if elapsed > stat['max']:
+                stat['max'] = elapsed
+
+def stats():
+        """Return a copy of the per-method latency stats, with the average in seconds"""
+        with _stats_lock:
+            result = {}
+            for method, stat in _stats.items():
+                result[method] = dict(stat, avg=stat['total'] / stat['count'])
+            return result
+
+def print_stats():
+        """Print per-method request count and latency, and the retries of the transient failures"""
+        for method, stat in sorted(stats().items()):
+            print("HTTP {method}: {count} requests, latency avg:{avg:.3f}s min:{min:.3f}s max:{max:.3f}s".format(
+                    method=method, count=stat['count'], avg=stat['avg'], min=stat['min'], max=stat['max']))
+        if retries():
+            print("HTTP retries: {0} of the {1} retry budget".format(retries(), _settings['retry_budget']))
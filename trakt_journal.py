@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Write-ahead progress journal of the import batches
+# Each batch is written as pending before it is sent, then as done or failed
+# with its counts, so an interrupted import can be resumed
+# Dead-letter file of the items not found or in a failed batch, with the reason
+#
+
+import sys, os
+import asyncio
+import csv
+import hashlib
+import threading
+try:
+        import simplejson as json
+except:
+        sys.exit("Please use your favorite method to install the following module simplejson to use this script")
+
+class Journal(object):
+        """
+        Progress journal of a sync, one JSON line per event, thread safe
+        A batch is known by the hash of its list, type, position and payload, on resume the
+        batches done in a previous run are skipped and their counts reused
+        """
+        def __init__(self, path, resume=False):
+            self.path = path
+            self.lock = threading.Lock()
+            self.done = {}
+            self.cleaned = False
+            self.skipped = 0
+            if resume and os.path.exists(path):
+                self.load()
+                self.fp = open(path, 'a', encoding = 'utf-8')
+            else:
+                self.fp = open(path, 'w', encoding = 'utf-8')
+
+        def load(self):
+            """Read the batches done and the cleanup state of the previous runs"""
+            with open(self.path, 'r', encoding = 'utf-8') as fp:
+                for line in fp:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Last line cut by a crash
+                        continue
+                    if event.get('status') == 'cleaned':
+                        self.cleaned = True
+                    elif event.get('status') == 'done':
+                        self.done[event['hash']] = event
+                    elif event.get('hash') in self.done:
+                        del self.done[event['hash']]
+
+        def write(self, event):
+            """Append one event and flush it to disk before going on"""
+            with self.lock:
+                self.fp.write(json.dumps(event) + '\n')
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+
+        def key(self, options, ordinal, batch):
+            """Hash of a batch and its position, the same CSV and batch size give the same hashes"""
+            raw = json.dumps([options.list, options.type, ordinal, batch], sort_keys=True)
+            return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+        def skip(self, key, results):
+            """True if the batch was done by a previous run, its counts are added to the results"""
+            event = self.done.get(key)
+            if event is None:
+                return False
+            self.skipped += 1
+            for name in ('sentids', 'added', 'existing', 'deleted', 'not_found'):
+                if name in results and name in event:
+                    results[name] += event[name]
+            return True
+
+        def pending(self, key, count):
+            """Record a batch about to be sent"""
+            self.write({'hash' : key, 'status' : 'pending', 'sentids' : count})
+
+        def finish(self, options, key, count, result):
+            """
+            Record the result of a batch, done with its counts or failed if None
+            For the asyncio engine 'result' is a coroutine, the result is recorded once awaited
+            """
+            if asyncio.iscoroutine(result):
+                return self.finish_async(options, key, count, result)
+            if result:
+                event = {'hash' : key, 'status' : 'done', 'sentids' : count}
+                for name in ('added', 'existing', 'deleted'):
+                    if name in result and result[name]:
+                        event[name] = result[name][options.type]
+                if 'not_found' in result and result['not_found']:
+                    event['not_found'] = len(result['not_found'][options.type])
+                self.write(event)
+            else:
+                self.write({'hash' : key, 'status' : 'failed', 'sentids' : count})
+            return result
+
+        async def finish_async(self, options, key, count, call):
+            return self.finish(options, key, count, await call)
+
+        def clean(self):
+            """Record that the list was emptied, a resumed run does not empty it again"""
+            self.cleaned = True
+            self.write({'status' : 'cleaned'})
+
+        def close(self, remove=False):
+            """Close the journal, remove it once every batch is done"""
+            with self.lock:
+                self.fp.close()
+            if remove:
+                os.remove(self.path)
+
+# Columns of a dead-letter CSV, it can be read back as an import CSV
+_dead_letter_fields = ['trakt', 'imdb', 'tmdb', 'tvdb', 'tvrage', 'watched_at', 'rated_at', 'rating', 'list', 'reason']
+
+def not_found_items(batch, not_found):
+        """
+        Return the items of the batch matching the ids blocks of a not_found result
+        Trakt only echoes the ids, the sent item keeps its watched_at, rated_at and rating
+        """
+        index = {}
+        for item in batch:
+            for id_format, value in (item.get('ids') or {}).items():
+                index.setdefault((id_format, str(value)), item)
+        items = []
+        for entry in not_found:
+            match = None
+            for id_format, value in (entry.get('ids') or {}).items():
+                match = index.get((id_format, str(value)))
+                if match:
+                    break
+            items.append(match or entry)
+        return items
+
+class DeadLetter(object):
+        """
+        Dead-letter file of the items a sync did not import, thread safe
+        Each item is written as soon as its batch result is known, with the list and the reason,
+        as a CSV row or as a JSON line when the file name ends with .jsonl
+        An item is sent by one ID, the other ID columns of its CSV row are tracked until its
+        batch result is known so they are written with it, a retry can look it up by any of them
+        """
+        def __init__(self, path, delimiter=','):
+            self.path = path
+            self.lock = threading.Lock()
+            self.count = 0
+            self.row_ids = {} # (id format, id) of an item in flight -> every ID of its CSV row
+            self.fp = open(path, 'w', encoding = 'utf-8', newline='')
+            if path.endswith('.jsonl'):
+                self.writer = None
+            else:
+                self.writer = csv.DictWriter(self.fp, fieldnames=_dead_letter_fields, delimiter=delimiter,
+                                             quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+                self.writer.writeheader()
+
+        def track(self, item, row_ids):
+            """Keep every ID of the CSV row of an item until its batch result is known"""
+            with self.lock:
+                for id_format, value in item['ids'].items():
+                    self.row_ids[(id_format, str(value))] = row_ids
+
+        def forget(self, batch):
+            """Stop tracking the items of a batch, return them with every ID of their CSV row"""
+            items = []
+            with self.lock:
+                for item in batch:
+                    ids = {}
+                    for id_format, value in (item.get('ids') or {}).items():
+                        ids.update(self.row_ids.pop((id_format, str(value)), {}))
+                    if ids:
+                        item = dict(item, ids=dict(ids, **item['ids']))
+                    items.append(item)
+            return items
+
+        def write(self, items, list_name, reason):
+            """Append the items with the list and the reason, flushed before going on"""
+            with self.lock:
+                for item in items:
+                    if self.writer:
+                        row = dict((k, v) for k, v in item.items() if k != 'ids' and not isinstance(v, (dict, list)))
+                        row.update(item.get('ids') or {})
+                        row['list'] = list_name
+                        row['reason'] = reason
+                        self.writer.writerow(row)
+                    else:
+                        self.fp.write(json.dumps(dict(item, list=list_name, reason=reason)) + '\n')
+                    self.count += 1
+                self.fp.flush()
+
+        def record(self, options, batch, result):
+            """
+            Write the items not found by a sync API result, or the whole batch if it failed
+            For the asyncio engine 'result' is a coroutine, the items are written once awaited
+            """
+            if asyncio.iscoroutine(result):
+                return self.record_async(options, batch, result)
+            items = self.forget(batch)
+            if result is None:
+                self.write(items, options.list, 'failed')
+            elif result.get('not_found') and result['not_found'].get(options.type):
+                self.write(not_found_items(items, result['not_found'][options.type]), options.list, 'not_found')
+            return result
+
+        async def record_async(self, options, batch, call):
+            return self.record(options, batch, await call)
+
+        def close(self):
+            with self.lock:
+                self.fp.close()
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#------------------------------------------------------------------------
+# Trakt.tv tools
+#
+# Copyright 2016-2021 xbgmsharp <xbgmsharp@gmail.com>. All Rights Reserved.
+# License:  GNU General Public License version 3 or later; see LICENSE.txt
+# Website:  https://trakt.tv, https://github.com/xbgmsharp/trakt
+#------------------------------------------------------------------------
+#
+# Purpose:
+# Run metrics of the Trakt.tv tools
+# Per endpoint request counts, latency histograms and bytes, retries, rate limit
+# waits and the items per second of each pipeline stage, dumped at the end of
+# the run as JSON or Prometheus text
+#
+
+import sys
+import atexit
+import contextlib
+import threading
+import time
+import urllib.parse
+try:
+        import simplejson as json
+except:
+        sys.exit("Please use your favorite method to install the following module simplejson to use this script")
+
+# Upper bounds in seconds of the latency histogram buckets
+_buckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+_metrics = {
+        'enabled'  : False, # Nothing is measured until enable() is called
+        'path'     : None,  # File the metrics are dumped to at exit
+        'start'    : 0.0,   # time.perf_counter() at enable()
+        'requests' : {},    # (method, host, endpoint) -> request metrics
+        'counters' : {},    # name -> value
+        'stages'   : {},    # name -> {'items', 'seconds'}
+}
+_lock = threading.Lock()
+_local = threading.local()
+
+def enabled():
+        """True if the metrics are measured"""
+        return _metrics['enabled']
+
+def enable(path):
+        """Start measuring, the metrics are dumped to 'path' when the program exits"""
+        _metrics['enabled'] = True
+        _metrics['path'] = path
+        _metrics['start'] = time.perf_counter()
+        atexit.register(dump)
+
+def endpoint(url):
+        """
+        Return the path of a URL as a metric label, without the IDs
+        eg: /users/me/lists/comedy/items -> /users/:user/lists/:list/items
+        The API version leading the path is kept, eg: /3/discover/movie
+        """
+        parts = urllib.parse.urlsplit(url).path.strip('/').split('/')
+        for i, part in enumerate(parts):
+            if i == 0:
+                continue
+            elif part.isdigit():
+                parts[i] = ':id'
+            elif parts[i - 1] == 'users' and part != 'settings':
+                parts[i] = ':user'
+            elif parts[i - 1] == 'lists' and parts[0] == 'users':
+                parts[i] = ':list'
+        return '/' + '/'.join(parts)
+
+def observe(method, url, elapsed, status, sent=0, received=0):
+        """Record one HTTP request, 'status' is the HTTP status or the name of the error"""
+        if not _metrics['enabled']:
+            return
+        key = (method, urllib.parse.urlsplit(url).hostname or '', endpoint(url))
+        with _lock:
+            metric = _metrics['requests'].get(key)
+            if metric is None:
+                metric = {'count' : 0, 'status' : {}, 'seconds' : 0.0, 'buckets' : [0] * (len(_buckets) + 1),
+                          'sent_bytes' : 0, 'received_bytes' : 0}
+                _metrics['requests'][key] = metric
+            metric['count'] += 1
+            metric['status'][str(status)] = metric['status'].get(str(status), 0) + 1
+            metric['seconds'] += elapsed
+            bucket = 0
+            while bucket < len(_buckets) and elapsed > _buckets[bucket]:
+                bucket += 1
+            metric['buckets'][bucket] += 1
+            metric['sent_bytes'] += sent
+            metric['received_bytes'] += received
+
+def count(name, value=1):
+        """Add to a counter, eg: retries or rate_limit_wait_seconds"""
+        if not _metrics['enabled']:
+            return
+        with _lock:
+            _metrics['counters'][name] = _metrics['counters'].get(name, 0) + value
+
+def stage(name, items, seconds):
+        """Record the items done by a pipeline stage and the seconds spent on them"""
+        if not _metrics['enabled']:
+            return
+        with _lock:
+            metric = _metrics['stages'].setdefault(name, {'items' : 0, 'seconds' : 0.0})
+            metric['items'] += items
+            metric['seconds'] += seconds
+
+def timed(name, items, size=None):
+        """
+        Iterate over items and record them as the pipeline stage 'name'
+        Only the time spent in the stage itself is counted, not in the timed stages it reads from
+        'size' returns the number of items a produced value stands for, eg: len for a batch
+        """
+        if not _metrics['enabled']:
+            return items
+        return _timed(name, iter(items), size)
+
+def _timed(name, items, size):
+        while True:
+            outer = getattr(_local, 'inner', 0.0)
+            _local.inner = 0.0
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                elapsed = time.perf_counter() - start
+                stage(name, 0, elapsed - _local.inner)
+                _local.inner = outer + elapsed
+                return
+            elapsed = time.perf_counter() - start
+            stage(name, size(item) if size else 1, elapsed - _local.inner)
+            _local.inner = outer + elapsed
+            yield item
+
+@contextlib.contextmanager
+def timing(name):
+        """
+        Time a block as the pipeline stage 'name', the block sets the number of items done in the yielded dict
+        Only the time spent in the block itself is counted, not in the timed stages it reads from
+        """
+        done = {'items' : 0}
+        if not _metrics['enabled']:
+            yield done
+            return
+        outer = getattr(_local, 'inner', 0.0)
+        _local.inner = 0.0
+        start = time.perf_counter()
+        try:
+            yield done
+        finally:
+            elapsed = time.perf_counter() - start
+            stage(name, done['items'], elapsed - _local.inner)
+            _local.inner = outer + elapsed
+
+def snapshot():
+        """Return the metrics as a dict, ready to be written as JSON"""
+        with _lock:
+            requests = []
+            for (method, host, path), metric in sorted(_metrics['requests'].items()):
+                buckets = dict((str(bound), n) for bound, n in zip(_buckets + ['+Inf'], metric['buckets']))
+                requests.append(dict(metric, method=method, host=host, endpoint=path, buckets=buckets))
+            stages = {}
+            for name, metric in _metrics['stages'].items():
+                stages[name] = dict(metric, items_per_second=metric['items'] / metric['seconds'] if metric['seconds'] > 0 else None)
+            return {'elapsed' : time.perf_counter() - _metrics['start'], 'requests' : requests,
+                    'counters' : dict(_metrics['counters']), 'stages' : stages}
+
+def prometheus(metrics):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+        def add(name, kind, text, samples):
+            lines.append('# HELP trakt_{0} {1}'.format(name, text))
+            lines.append('# TYPE trakt_{0} {1}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join('{0}="{1}"'.format(k, v) for k, v in labels)
+                lines.append('trakt_{0}{1}{2} {3}'.format(name, suffix, '{' + label + '}' if label else '', value))
+        add('run_seconds', 'gauge', 'Duration of the run', [('', [], metrics['elapsed'])])
+        requests = metrics['requests']
+        add('http_requests_total', 'counter', 'HTTP requests by endpoint and status',
+            [('', [('method', r['method']), ('host', r['host']), ('endpoint', r['endpoint']), ('status', status)], n)
+             for r in requests for status, n in sorted(r['status'].items())])
+        samples = []
+        for r in requests:
+            labels = [('method', r['method']), ('host', r['host']), ('endpoint', r['endpoint'])]
+            total = 0
+            for bound in _buckets + ['+Inf']:
+                total += r['buckets'][str(bound)]
+                samples.append(('_bucket', labels + [('le', bound)], total))
+            samples.append(('_sum', labels, r['seconds']))
+            samples.append(('_count', labels, r['count']))
+        add('http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint', samples)
+        add('http_sent_bytes_total', 'counter', 'HTTP request body bytes by endpoint',
+            [('', [('method', r['method']), ('host', r['host']), ('endpoint', r['endpoint'])], r['sent_bytes']) for r in requests])
+        add('http_received_bytes_total', 'counter', 'HTTP response body bytes by endpoint',
+            [('', [('method', r['method']), ('host', r['host']), ('endpoint', r['endpoint'])], r['received_bytes']) for r in requests])
+        for name, value in sorted(metrics['counters'].items()):
+            add(name + '_total', 'counter', name.replace('_', ' ').capitalize(), [('', [], value)])
+        stages = sorted(metrics['stages'].items())
+        add('stage_items_total', 'counter', 'Items done by each pipeline stage',
+            [('', [('stage', name)], stage['items']) for name, stage in stages])
+        add('stage_seconds_total', 'counter', 'Seconds spent in each pipeline stage',
+            [('', [('stage', name)], stage['seconds']) for name, stage in stages])
+        return '\n'.join(lines) + '\n'
+
+def dump(path=None):
+        """Write the metrics to 'path', as Prometheus text if it ends with .prom, as JSON otherwise"""
+        path = path or _metrics['path']
+        if not path or not _metrics['enabled']:
+            return
+        metrics = snapshot()
+        with open(path, 'w', encoding = 'utf-8') as fp:
+            if path.endswith('.prom'):
+                fp.write(prometheus(metrics))
+            else:
+                fp.write(json.dumps(metrics, indent=4, sort_keys=True))
+        print("Metrics written to {0}".format(path))